@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# (C) Copyright 2008 Kulbir Saini <kulbirsaini@students.iiit.ac.in>
+#
+
+"""
+Helpers shared by the benchmarks. A benchmark runs intelligentmirror from
+this source tree against a scratch directory holding its configuration,
+cache, RPC socket and log, so an installed copy is never touched.
+"""
+
+__author__ = """Kulbir Saini <kulbirsaini@students.iiit.ac.in>"""
+__docformat__ = 'plaintext'
+
+import math
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import traceback
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, 'intelligentmirror'))
+
+def load(options = {}):
+    """Write a configuration pointing into a new scratch directory, with
+    options overriding the defaults, and import intelligentmirror with it.
+    Returns the module."""
+    dir = tempfile.mkdtemp(prefix = 'im-bench-')
+    settings = {
+        'base_dir' : os.path.join(dir, 'cache') + '/',
+        'rpc_socket' : os.path.join(dir, 'pool.sock'),
+        'logfile' : os.path.join(dir, 'intelligentmirror.log'),
+    }
+    settings.update(options)
+    config = os.path.join(dir, 'intelligentmirror.conf')
+    file = open(config, 'w')
+    try:
+        file.write('[main]\n')
+        for (name, value) in settings.items():
+            file.write('%s = %s\n' % (name, value))
+    finally:
+        file.close()
+    os.environ['INTELLIGENTMIRROR_CONF'] = config
+    import intelligentmirror
+    intelligentmirror.log = intelligentmirror.set_logging()
+    intelligentmirror.scratch_dir = dir
+    return intelligentmirror
+
+def cleanup(im):
+    """Write out the log of im and remove its scratch directory."""
+    im.log.close()
+    shutil.rmtree(im.scratch_dir, True)
+
+def fresh_cache(im):
+    """Empty the cache directory of im and create its subdirectories, like
+    update-im does for an installed copy."""
+    if os.path.exists(im.base_dir):
+        shutil.rmtree(im.base_dir)
+    for dir in (im.temp_dir, im.blob_dir, im.rpm_cache_dir, im.deb_cache_dir):
+        os.makedirs(dir)
+
+def seed(path, size):
+    """Create a sparse file of size bytes at path."""
+    dir = os.path.dirname(path)
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    file = open(path, 'wb')
+    try:
+        file.truncate(size)
+    finally:
+        file.close()
+
+def fork(function, *args):
+    """Run function(*args) in a child process and return its pid."""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            try:
+                function(*args)
+            except:
+                traceback.print_exc()
+        finally:
+            os._exit(0)
+    return pid
+
+def start_pool(im, timeout = 10):
+    """Start the RPC server of im in a child process, as the first instance
+    of intelligentmirror does, and point im.package_pool at it. Returns the
+    pid of the child."""
+    pid = fork(im.start_rpc_server)
+    im.package_pool = im.PoolProxy(im.rpc_socket)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            im.package_pool.get_conn_number()
+            return pid
+        except Exception, e:
+            if time.time() > deadline:
+                stop([pid])
+                raise RuntimeError('RPC server did not start: %s' % e)
+            time.sleep(0.05)
+
+def stop(pids):
+    """Terminate the child processes pids and wait for them."""
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    for pid in pids:
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+def rss(pid):
+    """Return the resident memory of process pid in kilo bytes, or 0 if it
+    can't be read from /proc."""
+    try:
+        file = open('/proc/%d/status' % pid)
+        try:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+        finally:
+            file.close()
+    except IOError:
+        pass
+    return 0
+
+def percentile(values, p):
+    """Return the p-th percentile of the sorted list values, by the
+    nearest rank method."""
+    if not values:
+        return 0.0
+    return values[max(0, int(math.ceil(len(values) * p / 100.0)) - 1)]
+
+def print_table(header, rows):
+    """Print rows, lists of values, in columns under header. Floats are
+    printed with three decimals."""
+    lines = [header]
+    for row in rows:
+        cells = []
+        for value in row:
+            if isinstance(value, float):
+                cells.append('%.3f' % value)
+            else:
+                cells.append(str(value))
+        lines.append(cells)
+    widths = [max([len(line[i]) for line in lines]) for i in range(len(header))]
+    for line in lines:
+        cells = [line[0].ljust(widths[0])] + [line[i].rjust(widths[i]) for i in range(1, len(line))]
+        print '  '.join(cells)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# (C) Copyright 2008 Kulbir Saini <kulbirsaini@students.iiit.ac.in>
+#
+
+"""
+Measure the operations of PackagePool with 1k, 10k and 100k queued
+packages, and as many cached ones, and report ops/sec for every operation
+and size. An operation whose rate falls as the pool grows doesn't run in
+constant time. Each operation is timed for a fixed time rather than a
+fixed number of calls, so that the linear ones don't take forever.
+
+The pool is measured in-process, to see the cost of the operations
+themselves, and through PoolServer, as used by intelligentmirror. The
+resident memory taken by the filled pool is reported as well. Every size
+is measured in a new process, so the memory freed by a smaller pool
+doesn't hide the growth of a larger one.
+
+Usage: python benchmarks/pool.py [options]
+"""
+
+__author__ = """Kulbir Saini <kulbirsaini@students.iiit.ac.in>"""
+__docformat__ = 'plaintext'
+
+import common
+import marshal
+import optparse
+import os
+import time
+import traceback
+
+def package(number):
+    return 'fedora/updates/9/i386/pkg%06d-1.0-1.fc9.i386.rpm' % number
+
+def details(im, number):
+    """Return the details of a queued package as set by cache_package()."""
+    return ['10.0.0.1', 'http://mirror.example.com/pub/fedora/linux/updates/9/i386/pkg%06d-1.0-1.fc9.i386.rpm' % number, os.path.join(im.rpm_cache_dir, package(number)), 0755, package(number), 'RPM', 0, 0]
+
+def fill(im, pool, size, batch):
+    """Queue size packages with their details in pool and catalogue as
+    many other packages. Calls are sent batch at a time through a pipeline
+    if pool is a PoolProxy."""
+    pipelined = isinstance(pool, im.PoolProxy)
+    calls = pool
+    for number in range(size):
+        if pipelined and number % batch == 0:
+            if number:
+                calls.execute()
+            calls = pool.pipeline()
+        calls.add(package(number))
+        calls.set(package(number), details(im, number))
+        calls.add_cached('RPM', package(size + number), 100 * 1024, '')
+    if pipelined:
+        calls.execute()
+
+def operations(im, pool, size):
+    """
+    Return a list of (name, function) where function(i) calls the
+    operation with the i-th argument. Operations which change the pool are
+    paired with the calls undoing the change, so the pool keeps its size.
+    """
+    def add_remove(i):
+        pool.add('new')
+        pool.remove('new')
+    def set(i):
+        pool.set(package(i % size), details(im, i % size))
+    def add_or_inc_score(i):
+        pool.add_or_inc_score(package(i % size))
+    def get_details(i):
+        pool.get_details(package(i % size))
+    def get_popular(i):
+        pool.get_popular()
+    def schedule(i):
+        params = pool.next_download(size + 1)
+        pool.remove_conn(params[4])
+        pool.add(params[4])
+    def is_active(i):
+        pool.is_active(package(i % size))
+    def hit_miss(i):
+        pool.hit('RPM', 'missing')
+    def hit(i):
+        pool.hit('RPM', package(size + i % size))
+    def get(i):
+        pool.get()
+    def get_metrics(i):
+        pool.get_metrics()
+    return [
+        ('add + remove', add_remove),
+        ('set', set),
+        ('add_or_inc_score', add_or_inc_score),
+        ('get_details', get_details),
+        ('get_popular', get_popular),
+        ('next_download + remove_conn + add', schedule),
+        ('is_active', is_active),
+        ('hit (not cached)', hit_miss),
+        ('hit (cached)', hit),
+        ('get', get),
+        ('get_metrics', get_metrics),
+    ]
+
+def measure(function, seconds):
+    """Call function(i) for i = 0, 1, ... for about seconds and return the
+    calls per second."""
+    calls = 0
+    start = time.time()
+    while True:
+        for i in range(calls, calls + 10):
+            function(i)
+        calls += 10
+        elapsed = time.time() - start
+        if elapsed >= seconds:
+            return calls / elapsed
+
+def measure_size(im, mode, size, options):
+    """Fill a pool with size packages and return (memory taken in kilo
+    bytes, [(operation, calls per second)])."""
+    common.fresh_cache(im)
+    if mode == 'in-process':
+        before = common.rss(os.getpid())
+        pool = im.PackagePool(im.Catalogue(im.catalogue_file))
+        fill(im, pool, size, options.batch)
+        memory = common.rss(os.getpid()) - before
+    else:
+        server = common.start_pool(im)
+        pool = im.package_pool
+        before = common.rss(server)
+        fill(im, pool, size, options.batch)
+        memory = common.rss(server) - before
+    try:
+        rates = [(name, measure(function, options.seconds)) for (name, function) in operations(im, pool, size)]
+    finally:
+        if mode == 'rpc':
+            common.stop([server])
+    return (memory, rates)
+
+def in_child(function, *args):
+    """Return function(*args) computed in a child process. The result must
+    be marshallable."""
+    (read, write) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            try:
+                os.write(write, marshal.dumps(function(*args)))
+            except:
+                traceback.print_exc()
+        finally:
+            os._exit(0)
+    os.close(write)
+    data = ''
+    while True:
+        chunk = os.read(read, 65536)
+        if not chunk:
+            break
+        data += chunk
+    os.close(read)
+    os.waitpid(pid, 0)
+    if not data:
+        raise RuntimeError('measuring failed')
+    return marshal.loads(data)
+
+def main():
+    parser = optparse.OptionParser(usage = '%prog [options]')
+    parser.add_option('-s', '--sizes', default = '1000,10000,100000', help = 'comma separated numbers of queued packages [%default]')
+    parser.add_option('-m', '--mode', action = 'append', help = 'in-process or rpc, may be repeated [both]')
+    parser.add_option('--seconds', type = 'float', default = 0.5, help = 'seconds to time each operation for [%default]')
+    parser.add_option('--batch', type = 'int', default = 1000, help = 'calls per pipeline while filling the pool over RPC [%default]')
+    (options, args) = parser.parse_args()
+    sizes = [int(size) for size in options.sizes.split(',')]
+    modes = options.mode or ['in-process', 'rpc']
+    for mode in modes:
+        if mode not in ('in-process', 'rpc'):
+            parser.error('invalid mode "%s"' % mode)
+
+    im = common.load()
+    try:
+        for mode in modes:
+            results = [in_child(measure_size, im, mode, size, options) for size in sizes]
+            rows = []
+            for i in range(len(results[0][1])):
+                rows.append([results[0][1][i][0]] + ['%.0f' % rates[i][1] for (memory, rates) in results])
+            rows.append(['memory MB'] + [memory / 1024.0 for (memory, rates) in results])
+            rows.append(['memory bytes/package'] + [memory * 1024 / size for ((memory, rates), size) in zip(results, sizes)])
+            print '%s, ops/sec' % mode
+            common.print_table(['operation'] + [str(size) for size in sizes], rows)
+            print
+    finally:
+        common.cleanup(im)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# (C) Copyright 2008 Kulbir Saini <kulbirsaini@students.iiit.ac.in>
+#
+
+"""
+Check the prefetcher offline against a fake yum repository and a fake apt
+archive written as file urls into the scratch directory. Both list older,
+the same, newer and newest versions of every package, and version 2.0 of
+some of them is cached. The metadata is read and the newer versions of the
+cached packages queued as prefetcher() does, and the time taken is
+reported. Exits with an error if not exactly the newest version of every
+cached package was queued.
+
+Usage: python benchmarks/prefetch.py [options]
+"""
+
+__author__ = """Kulbir Saini <kulbirsaini@students.iiit.ac.in>"""
+__docformat__ = 'plaintext'
+
+import common
+import gzip
+import optparse
+import os
+import time
+import urlparse
+
+# Versions listed for every package, the last one being the newest. 10.0
+# sorts before 2.0 as a string.
+versions = ['1.0', '2.0', '2.0~rc1', '2.9', '10.0']
+
+class FileGrabber:
+    """Read file urls like the urlgrabber of intelligentmirror."""
+    def urlread(self, url):
+        file = open(urlparse.urlsplit(url)[2], 'rb')
+        try:
+            return file.read()
+        finally:
+            file.close()
+
+def write_gzip(path, text):
+    dir = os.path.dirname(path)
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    file = gzip.GzipFile(path, 'wb')
+    try:
+        file.write(text)
+    finally:
+        file.close()
+
+def yum_file(number, version):
+    return 'Packages/pkg%06d-%s-1.fc9.i386.rpm' % (number, version)
+
+def deb_file(number, version):
+    return 'pool/main/p/pkg%06d/pkg%06d_%s-1_i386.deb' % (number, number, version)
+
+def yum_repo(dir, size):
+    """Write a yum repository listing the versions of size packages under
+    dir. Returns its url."""
+    packages = []
+    for number in range(size):
+        for version in versions:
+            packages.append('<package type="rpm"><name>pkg%06d</name><arch>i386</arch>'
+                '<version epoch="0" ver="%s" rel="1.fc9"/>'
+                '<location href="%s"/></package>' % (number, version, yum_file(number, version)))
+    write_gzip(os.path.join(dir, 'repodata', 'primary.xml.gz'),
+        '<?xml version="1.0"?>\n<metadata packages="%d">%s</metadata>\n' % (len(packages), ''.join(packages)))
+    file = open(os.path.join(dir, 'repodata', 'repomd.xml'), 'w')
+    try:
+        file.write('<?xml version="1.0"?>\n<repomd><data type="primary">'
+            '<location href="repodata/primary.xml.gz"/></data></repomd>\n')
+    finally:
+        file.close()
+    return 'file://' + dir
+
+def apt_repo(dir, size):
+    """Write an apt archive listing the versions of size packages under dir.
+    Returns the url of its Packages.gz."""
+    packages = []
+    for number in range(size):
+        for version in versions:
+            packages.append('Package: pkg%06d\nVersion: %s-1\nArchitecture: i386\n'
+                'Filename: %s\nDescription: package %d\n second line\n\n' % (number, version, deb_file(number, version), number))
+    path = os.path.join(dir, 'dists', 'lenny', 'main', 'binary-i386', 'Packages.gz')
+    write_gzip(path, ''.join(packages))
+    return 'file://' + path
+
+def seed_cache(im, cached):
+    """Cache versions 1.0 and 2.0 of the first cached packages of both
+    kinds."""
+    for number in range(cached):
+        for version in ('1.0', '2.0'):
+            common.seed(os.path.join(im.rpm_cache_dir, 'fedora/updates/9/i386', os.path.basename(yum_file(number, version))), 1024)
+            common.seed(os.path.join(im.deb_cache_dir, 'debian', deb_file(number, version)), 1024)
+
+def newest_queued(im, cached, url, path):
+    """Return whether the newest version of the first cached packages in
+    the repository at url is queued. path(number, version) is the path of
+    a package in the repository."""
+    base = urlparse.urlsplit(url)[2]
+    if base.endswith('.gz'):
+        base = base[:base.rfind('/dists/')]
+    for number in range(cached):
+        key = im.canonicalizer.key('', os.path.join(base, path(number, versions[-1])))
+        if not im.package_pool.get_details(key):
+            return False
+    return True
+
+def main():
+    parser = optparse.OptionParser(usage = '%prog [options]')
+    parser.add_option('-p', '--packages', type = 'int', default = 10000, help = 'packages in each repository [%default]')
+    parser.add_option('-c', '--cached', type = 'int', default = 1000, help = 'packages with version 2.0 cached [%default]')
+    (options, args) = parser.parse_args()
+    if options.cached > options.packages:
+        parser.error('more cached packages than packages')
+
+    im = common.load()
+    pids = []
+    try:
+        common.fresh_cache(im)
+        seed_cache(im, options.cached)
+        repos = [('yum', 'RPM', yum_repo(os.path.join(im.scratch_dir, 'yum'), options.packages), yum_file),
+            ('apt', 'DEB', apt_repo(os.path.join(im.scratch_dir, 'apt'), options.packages), deb_file)]
+        pids.append(common.start_pool(im))
+        grabber = FileGrabber()
+        cached = im.cached_versions()
+        rows = []
+        failed = []
+        for (kind, type, url, path) in repos:
+            start = time.time()
+            packages = im.repo_packages(grabber, kind, url)
+            read = time.time() - start
+            start = time.time()
+            queued = im.prefetch_packages(im.package_pool, cached, type, packages)
+            rows.append([kind, len(packages), queued, read, time.time() - start])
+            if len(packages) != options.packages * len(versions) or queued != options.cached or not newest_queued(im, options.cached, url, path):
+                failed.append(kind)
+        common.print_table(['repository', 'packages', 'queued', 'read sec', 'queue sec'], rows)
+        if failed:
+            raise SystemExit('expected %d packages and the newest version of %d queued for %s' % (options.packages * len(versions), options.cached, ', '.join(failed)))
+    finally:
+        common.stop(pids)
+        common.cleanup(im)
+
+if __name__ == '__main__':
+    main()
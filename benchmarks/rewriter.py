@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# (C) Copyright 2008 Kulbir Saini <kulbirsaini@students.iiit.ac.in>
+#
+
+"""
+Replay squid url_rewrite requests against squid_part(), the loop squid
+waits on for every request, and report requests/sec and the p50/p99
+latency of the answers.
+
+The helper runs in a child process reading its requests from a pipe, and
+talks to an RPC server in another child, as it does under squid. Both use
+a scratch cache directory seeded with sparse packages. The requests name
+packages on mirror hosts which are never contacted: the helper only
+answers from the catalogue and queues the misses, which nothing downloads.
+See soak.py for the downloads.
+
+Synthetic workloads mix requests for cached packages (hits), packages
+which are not cached (misses, some of them requested repeatedly) and
+other urls. A recorded trace holds one request per line as squid writes
+it to the helper, i.e. url client_ip/fqdn ident method, optionally
+preceded by a channel ID. Its packages are seeded into the cache with
+probability --hit-ratio.
+
+With --rate, requests are sent at that rate and the latency of a request
+is counted from the time it was due, so a helper falling behind shows up
+in the latency instead of slowing down the replay.
+
+Usage: python benchmarks/rewriter.py [options]
+"""
+
+__author__ = """Kulbir Saini <kulbirsaini@students.iiit.ac.in>"""
+__docformat__ = 'plaintext'
+
+import common
+import optparse
+import os
+import random
+import select
+import time
+import urlparse
+
+# Name -> fractions of (hits, misses, other urls).
+workloads = [
+    ('hit-heavy', (0.9, 0.1, 0.0)),
+    ('miss-heavy', (0.1, 0.9, 0.0)),
+    ('mixed', (0.4, 0.4, 0.2)),
+]
+
+mirrors = ['mirror%d.example.com' % i for i in range(1, 6)]
+
+def package_url(type, number):
+    """Return the url of a synthetic package on a random mirror."""
+    host = random.choice(mirrors)
+    name = 'pkg%06d' % number
+    if type == 'RPM':
+        return 'http://%s/pub/fedora/linux/updates/9/i386/%s-1.0-1.fc9.i386.rpm' % (host, name)
+    return 'http://%s/debian/pool/main/%s/%s/%s_1.0-1_i386.deb' % (host, name[0], name, name)
+
+def package_size():
+    """Return a package size in bytes, most packages being small."""
+    return int(min(random.lognormvariate(12.5, 1.5), 200 * 1024 * 1024))
+
+def request(url):
+    return '%s 10.0.%d.%d/- - GET' % (url, random.randint(0, 255), random.randint(1, 254))
+
+def synthetic(fractions, requests, cached, uncached):
+    """Return requests request lines of a synthetic workload."""
+    (hits, misses, other) = fractions
+    lines = []
+    for i in range(requests):
+        type = random.choice(('RPM', 'DEB'))
+        draw = random.random()
+        if draw < hits:
+            url = package_url(type, random.randrange(cached))
+        elif draw < hits + misses:
+            url = package_url(type, cached + random.randrange(uncached))
+        else:
+            url = 'http://%s/pub/index%d.html' % (random.choice(mirrors), random.randrange(1000))
+        lines.append(request(url))
+    return lines
+
+def read_trace(path):
+    """Return the request lines of a recorded trace without channel IDs."""
+    lines = []
+    file = open(path)
+    try:
+        for line in file:
+            fields = line.split()
+            if fields and fields[0].isdigit():
+                fields = fields[1:]
+            if len(fields) >= 2:
+                lines.append(' '.join(fields))
+    finally:
+        file.close()
+    return lines
+
+def cache_path(im, url):
+    """Return the path at which the package at url is cached, or None if
+    url is not a package."""
+    (scheme, host, path, query, fragment) = urlparse.urlsplit(url)
+    key = im.canonicalizer.key(host, path)
+    if key is None:
+        return None
+    if path.endswith('.rpm'):
+        return os.path.join(im.rpm_cache_dir, key)
+    if path.endswith('.deb'):
+        return os.path.join(im.deb_cache_dir, key)
+    return None
+
+def seed_synthetic(im, cached):
+    for type in ('RPM', 'DEB'):
+        for number in range(cached):
+            common.seed(cache_path(im, package_url(type, number)), package_size())
+
+def seed_trace(im, lines, hit_ratio):
+    seen = {}
+    for line in lines:
+        path = cache_path(im, line.split()[0])
+        if path is None or path in seen:
+            continue
+        seen[path] = True
+        if random.random() < hit_ratio:
+            common.seed(path, package_size())
+
+def helper(im, requests, replies):
+    """Run squid_part() with requests as stdin and replies as stdout."""
+    os.dup2(requests, 0)
+    os.dup2(replies, 1)
+    im.package_pool = im.PoolProxy(im.rpc_socket)
+    im.squid_part()
+
+def replay(lines, requests, replies, rate, concurrency, redirect):
+    """
+    Send lines to the helper and collect its answers. Returns (seconds
+    taken, sorted latencies, number of answers starting with redirect).
+    Up to concurrency requests are outstanding, or one if the helper
+    doesn't use channel IDs.
+    """
+    window = max(1, concurrency)
+    # Map of request number -> time the request was due.
+    pending = {}
+    # Request numbers in the order they were sent, to match the answers
+    # of a helper without channel IDs.
+    sent = []
+    latencies = []
+    redirected = 0
+    buffer = ''
+    next = 0
+    start = time.time()
+    while len(latencies) < len(lines):
+        now = time.time()
+        timeout = None
+        while next < len(lines) and len(pending) < window:
+            due = now
+            if rate:
+                due = start + next / rate
+                if due > now:
+                    timeout = due - now
+                    break
+            line = lines[next]
+            if concurrency:
+                line = '%d %s' % (next, line)
+            os.write(requests, line + '\n')
+            pending[next] = due
+            if not concurrency:
+                sent.append(next)
+            next += 1
+        if not select.select([replies], [], [], timeout)[0]:
+            continue
+        data = os.read(replies, 65536)
+        if not data:
+            raise RuntimeError('the helper exited')
+        buffer += data
+        while '\n' in buffer:
+            (answer, buffer) = buffer.split('\n', 1)
+            if concurrency:
+                (number, answer) = answer.split(' ', 1)
+                number = int(number)
+            else:
+                number = sent.pop(0)
+            latencies.append(time.time() - pending.pop(number))
+            if answer.startswith(redirect):
+                redirected += 1
+    elapsed = time.time() - start
+    latencies.sort()
+    return (elapsed, latencies, redirected)
+
+def run(im, name, lines, options, seed):
+    """Replay lines against a fresh cache seeded by seed() and return a
+    row of the report."""
+    common.fresh_cache(im)
+    seed()
+    pool = common.start_pool(im)
+    (requests_read, requests) = os.pipe()
+    (replies, replies_written) = os.pipe()
+    pid = common.fork(helper, im, requests_read, replies_written)
+    os.close(requests_read)
+    os.close(replies_written)
+    try:
+        (elapsed, latencies, redirected) = replay(lines, requests, replies, options.rate, options.concurrency, im.redirect + ':')
+    finally:
+        os.close(requests)
+        os.close(replies)
+        common.stop([pid, pool])
+    return [name, len(lines), redirected, len(lines) / elapsed, common.percentile(latencies, 50) * 1000, common.percentile(latencies, 99) * 1000, latencies[-1] * 1000]
+
+def main():
+    parser = optparse.OptionParser(usage = '%prog [options]')
+    parser.add_option('-n', '--requests', type = 'int', default = 10000, help = 'requests per synthetic workload [%default]')
+    parser.add_option('-r', '--rate', type = 'float', default = 0, help = 'requests per second, 0 to send each request as soon as there is room [%default]')
+    parser.add_option('-c', '--concurrency', type = 'int', default = 0, help = 'url_rewrite_concurrency of the helper [%default]')
+    parser.add_option('-w', '--workload', action = 'append', help = 'synthetic workload to run, may be repeated [all]')
+    parser.add_option('--cached', type = 'int', default = 5000, help = 'cached packages of each type [%default]')
+    parser.add_option('--uncached', type = 'int', default = 20000, help = 'packages of each type which may be missed [%default]')
+    parser.add_option('-t', '--trace', action = 'append', help = 'recorded trace to replay instead of the synthetic workloads, may be repeated')
+    parser.add_option('--hit-ratio', type = 'float', default = 0.5, help = 'fraction of the packages of a trace which are cached [%default]')
+    parser.add_option('--seed', type = 'int', default = 1, help = 'seed of the random numbers [%default]')
+    (options, args) = parser.parse_args()
+
+    im = common.load({'url_rewrite_concurrency' : options.concurrency})
+    rows = []
+    try:
+        if options.trace:
+            for path in options.trace:
+                random.seed(options.seed)
+                lines = read_trace(path)
+                rows.append(run(im, os.path.basename(path), lines, options, lambda: seed_trace(im, lines, options.hit_ratio)))
+        else:
+            for (name, fractions) in workloads:
+                if options.workload and name not in options.workload:
+                    continue
+                random.seed(options.seed)
+                lines = synthetic(fractions, options.requests, options.cached, options.uncached)
+                rows.append(run(im, name, lines, options, lambda: seed_synthetic(im, options.cached)))
+    finally:
+        common.cleanup(im)
+    common.print_table(['workload', 'requests', 'hits', 'req/s', 'p50 ms', 'p99 ms', 'max ms'], rows)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# (C) Copyright 2008 Kulbir Saini <kulbirsaini@students.iiit.ac.in>
+#
+
+"""
+Soak the download pipeline with a burst of misses and report how long
+the packages took to be cached, the aggregate throughput, and the peak
+memory and number of processes used.
+
+A fake mirror on 127.0.0.1 serves a few thousand synthetic rpm and deb
+packages whose sizes follow a log-normal distribution, so most packages
+are small and a few are large. The packages are generated on the fly and
+have distinct contents. A burst of requests for some of them goes
+through rewrite(), which queues them as misses. download_scheduler()
+then hands them to the pre-forked download workers running
+download_from_source(), which fetch them from the mirror into a scratch
+cache directory.
+
+The time to cache a package runs from its request to its entry in the
+catalogue. Memory and processes are sampled from /proc for the
+benchmark, the RPC server and the download workers, the mirror being left
+out, and are reported as '-' where /proc is not available. The same
+options and seed give the same packages and requests, so reports of
+different versions can be compared.
+
+Usage: python benchmarks/soak.py [options]
+"""
+
+__author__ = """Kulbir Saini <kulbirsaini@students.iiit.ac.in>"""
+__docformat__ = 'plaintext'
+
+import common
+import BaseHTTPServer
+import optparse
+import os
+import random
+import SocketServer
+import threading
+import time
+import urlgrabber.grabber
+
+block_size = 64 * 1024
+
+def package_path(type, number):
+    name = 'pkg%06d' % number
+    if type == 'RPM':
+        return '/pub/fedora/linux/updates/9/x86_64/%s-1.0-1.fc9.x86_64.rpm' % name
+    return '/debian/pool/main/%s/%s/%s_1.0-1_amd64.deb' % (name[0], name, name)
+
+def manifest(packages, median, sigma, largest):
+    """Return a dictionary of path -> size in bytes of packages packages,
+    half of them rpms, with a median size of median bytes."""
+    sizes = {}
+    for number in range(packages):
+        type = ('RPM', 'DEB')[number % 2]
+        size = random.lognormvariate(0, sigma) * median
+        sizes[package_path(type, number)] = max(1024, int(min(size, largest)))
+    return sizes
+
+class MirrorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve the packages of the manifest of the server. A package starts
+    with its path, so that no two packages are the same, and is filled up
+    with the random block of the server."""
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        size = self.server.sizes.get(self.path)
+        if size is None:
+            self.send_error(404)
+            return
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.send_header('Last-Modified', 'Sat, 01 Nov 2008 00:00:00 GMT')
+        self.end_headers()
+        data = self.path + '\n' + self.server.block
+        sent = 0
+        while sent < size:
+            chunk = data[:size - sent]
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            data = self.server.block
+
+    def log_message(self, format, *args):
+        return
+
+class Mirror(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, sizes, delay):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), MirrorRequestHandler)
+        self.sizes = sizes
+        self.delay = delay
+        self.block = ''.join([chr(random.randrange(256)) for i in range(block_size)])
+
+class Sampler(threading.Thread):
+    """Sample the total resident memory, in kilo bytes, and the number of
+    the processes descending from this one, except those in exclude, and
+    remember the peaks."""
+    def __init__(self, exclude, interval = 0.1):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.exclude = exclude
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_processes = 0
+        self.available = os.path.exists('/proc/self/status')
+
+    def processes(self):
+        """Return the pids of this process and its descendants."""
+        children = {}
+        for name in os.listdir('/proc'):
+            if not name.isdigit():
+                continue
+            try:
+                file = open('/proc/%s/stat' % name)
+                try:
+                    stat = file.read()
+                finally:
+                    file.close()
+            except IOError:
+                continue
+            # The name of the command in parentheses may contain spaces.
+            ppid = int(stat[stat.rfind(')') + 2:].split()[1])
+            children.setdefault(ppid, []).append(int(name))
+        pids = []
+        pending = [os.getpid()]
+        while pending:
+            pid = pending.pop()
+            if pid in self.exclude:
+                continue
+            pids.append(pid)
+            pending.extend(children.get(pid, []))
+        return pids
+
+    def run(self):
+        if not self.available:
+            return
+        while True:
+            pids = self.processes()
+            self.peak_processes = max(self.peak_processes, len(pids))
+            self.peak_rss = max(self.peak_rss, sum([common.rss(pid) for pid in pids]))
+            time.sleep(self.interval)
+
+def schedule(im):
+    """Run download_scheduler() until the RPC server is stopped."""
+    try:
+        im.download_scheduler()
+    except:
+        # Packages the scheduler failed to download are reported as not
+        # cached.
+        pass
+
+def main():
+    parser = optparse.OptionParser(usage = '%prog [options]')
+    parser.add_option('-p', '--packages', type = 'int', default = 5000, help = 'packages on the mirror [%default]')
+    parser.add_option('-b', '--burst', type = 'int', default = 1000, help = 'packages requested in the burst [%default]')
+    parser.add_option('-d', '--downloads', type = 'int', default = 30, help = 'max_parallel_downloads [%default]')
+    parser.add_option('--median', type = 'int', default = 200, help = 'median package size in kilo bytes [%default]')
+    parser.add_option('--sigma', type = 'float', default = 1.3, help = 'spread of the log-normal package sizes [%default]')
+    parser.add_option('--largest', type = 'int', default = 50, help = 'largest package size in mega bytes [%default]')
+    parser.add_option('--delay', type = 'float', default = 0, help = 'seconds the mirror waits before answering [%default]')
+    parser.add_option('--timeout', type = 'int', default = 900, help = 'seconds to wait for the burst to be cached [%default]')
+    parser.add_option('--seed', type = 'int', default = 1, help = 'seed of the random numbers [%default]')
+    (options, args) = parser.parse_args()
+    if options.burst > options.packages:
+        parser.error('the burst can\'t be larger than the number of packages')
+
+    im = common.load({'max_parallel_downloads' : options.downloads, 'cache_host' : 'cache.invalid', 'download_retry_delay' : 1})
+    random.seed(options.seed)
+    sizes = manifest(options.packages, options.median * 1024, options.sigma, options.largest * 1024 * 1024)
+    paths = sizes.keys()
+    paths.sort()
+    burst = random.sample(paths, options.burst)
+    mirror = Mirror(sizes, options.delay)
+    base_url = 'http://127.0.0.1:%d' % mirror.server_address[1]
+    pids = []
+    im.workers = None
+    try:
+        mirror_pid = common.fork(mirror.serve_forever)
+        pids.append(mirror_pid)
+        mirror.server_close()
+        common.fresh_cache(im)
+        pids.append(common.start_pool(im))
+        # The RPC server runs in a child process, the scheduler needn't
+        # wait for it.
+        im.rpc_started.set()
+        # The workers are forked before any thread is started, like
+        # intelligentmirror does.
+        im.grabber = urlgrabber.grabber.URLGrabber()
+        im.workers = im.WorkerPool(im.max_parallel_downloads, im.download_from_source)
+        pids.extend([worker.pid for worker in im.workers.workers])
+        sampler = Sampler([mirror_pid])
+        sampler.start()
+        scheduler = threading.Thread(target = schedule, args = (im,))
+        scheduler.setDaemon(True)
+        scheduler.start()
+
+        requested = {}
+        start = time.time()
+        for path in burst:
+            im.rewrite([base_url + path, '10.0.0.%d/-' % random.randint(1, 254), '-', 'GET'])
+            requested[im.canonicalizer.key('127.0.0.1', path)] = time.time()
+        burst_time = time.time() - start
+        while time.time() - start < options.timeout:
+            calls = im.package_pool.pipeline()
+            calls.get()
+            calls.get_conn_number()
+            (queued, active) = calls.execute()
+            if not queued and not active:
+                break
+            time.sleep(0.1)
+        elapsed = time.time() - start
+
+        waits = []
+        cached_bytes = 0
+        last = start
+        for type in ('RPM', 'DEB'):
+            for (package, entry) in im.package_pool.get_cached(type).items():
+                if package in requested:
+                    waits.append(entry[im.INSERTED] - requested[package])
+                    cached_bytes += entry[im.SIZE]
+                    last = max(last, entry[im.INSERTED])
+        waits.sort()
+        took = max(last - start, 0.001)
+    finally:
+        if im.workers is not None:
+            # The workers exit once their job pipe is closed.
+            for worker in im.workers.workers:
+                worker.close()
+        common.stop(pids)
+        common.cleanup(im)
+
+    if sampler.available:
+        peak_rss = '%.1f' % (sampler.peak_rss / 1024.0)
+        peak_processes = sampler.peak_processes
+    else:
+        peak_rss = '-'
+        peak_processes = '-'
+    print 'packages %d, burst %d, max_parallel_downloads %d, median %d KB, seed %d' % (options.packages, options.burst, options.downloads, options.median, options.seed)
+    rows = [
+        ['requested', len(burst)],
+        ['cached', len(waits)],
+        ['not cached', len(burst) - len(waits)],
+        ['burst seconds', burst_time],
+        ['seconds to cache all', took],
+        ['time to cached p50 s', common.percentile(waits, 50)],
+        ['time to cached p99 s', common.percentile(waits, 99)],
+        ['time to cached max s', common.percentile(waits, 100)],
+        ['cached MB', cached_bytes / 1048576.0],
+        ['MB/s', cached_bytes / 1048576.0 / took],
+        ['packages/s', len(waits) / took],
+        ['peak RSS MB', peak_rss],
+        ['peak processes', peak_processes],
+    ]
+    if elapsed >= options.timeout:
+        rows.append(['timed out after s', elapsed])
+    common.print_table(['metric', 'value'], rows)
+
+if __name__ == '__main__':
+    main()
@@ -47,6 +47,7 @@ install -m 644 intelligentmirror_httpd.conf -T ${RPM_BUILD_ROOT}%{prefix}/etc/ht
 install -m 644 intelligentmirror.8.gz -T ${RPM_BUILD_ROOT}%{prefix}/usr/share/man/man8/intelligentmirror.8.gz
 install -m 744 update-im -T ${RPM_BUILD_ROOT}%{prefix}/usr/sbin/update-im
 touch ${RPM_BUILD_ROOT}%{prefix}/var/log/squid/intelligentmirror.log
+touch ${RPM_BUILD_ROOT}%{prefix}/etc/intelligentmirror.conf.snapshot
 
 %clean
 rm -rf $RPM_BUILD_ROOT
@@ -55,6 +56,7 @@ rm -rf $RPM_BUILD_DIR/%{name}-%{version}
 %files
 %{prefix}/etc/squid/intelligentmirror/
 %{prefix}/etc/intelligentmirror.conf
+%{prefix}/etc/intelligentmirror.conf.snapshot
 %{prefix}/etc/httpd/conf.d/intelligentmirror.conf
 %{prefix}/var/log/squid/intelligentmirror.log
 %{prefix}/usr/share/man/man8/intelligentmirror.8.gz
@@ -62,6 +64,7 @@ rm -rf $RPM_BUILD_DIR/%{name}-%{version}
 
 %post
 chown squid:squid ${RPM_BUILD_ROOT}%{prefix}/var/log/squid/intelligentmirror.log
+chown squid:squid ${RPM_BUILD_ROOT}%{prefix}/etc/intelligentmirror.conf.snapshot
 chown -R squid:squid ${RPM_BUILD_ROOT}%{prefix}/var/spool/squid/intelligentmirror
 echo "Reloading httpd service..."
 /sbin/service httpd reload
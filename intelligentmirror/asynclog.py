@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# (C) Copyright 2008 Kulbir Saini <kulbirsaini@students.iiit.ac.in>
+#
+
+"""
+Asynchronous logging. Log records are put on a queue by the threads
+serving squid and are formatted and written in batches by a background
+thread, so a slow disk never delays the answers to squid. All the
+processes append to the same log file, which is rotated by whichever
+process notices first that it has grown too large or too old. Records
+are written either as text lines or as JSON objects, one per line.
+"""
+
+__author__ = """Kulbir Saini <kulbirsaini@students.iiit.ac.in>"""
+__docformat__ = 'plaintext'
+
+import atexit
+import fcntl
+import os
+import Queue
+import threading
+import time
+
+levels = {
+    'debug' : 10,
+    'info' : 20,
+    'warning' : 30,
+    'error' : 40,
+}
+names = dict([(value, name) for (name, value) in levels.items()])
+
+def json_string(value):
+    """Return value as a JSON string. Bytes which are not ASCII are taken
+    to be latin-1 so that the result is always valid."""
+    chars = []
+    for char in str(value):
+        if char == '"' or char == '\\':
+            chars.append('\\' + char)
+        elif ' ' <= char <= '~':
+            chars.append(char)
+        else:
+            chars.append('\\u%04x' % ord(char))
+    return '"' + ''.join(chars) + '"'
+
+def json_value(value):
+    """Return value as JSON. '-' and None, used for missing values, are null."""
+    if value is None or value == '-':
+        return 'null'
+    if isinstance(value, (int, long, float)):
+        return repr(value)
+    return json_string(value)
+
+def parse_levels(text):
+    """Parse whitespace separated EVENT:level pairs into a dictionary of
+    event -> level. Raises ValueError for a malformed pair."""
+    event_levels = {}
+    for pair in text.split():
+        (event, level) = pair.split(':', 1)
+        if level.lower() not in levels:
+            raise ValueError('invalid log level "%s"' % pair)
+        event_levels[event] = levels[level.lower()]
+    return event_levels
+
+class RotatingLogFile:
+    """
+    Log file shared by several processes. The file is rotated once it has
+    reached max_bytes or is max_age seconds old, keeping backups old files.
+    A zero max_bytes or max_age disables that limit. The process rotating
+    the file holds a lock on filename.lock, whose modification time is the
+    time of the last rotation. The other processes notice the rotation and
+    reopen the file.
+    """
+    def __init__(self, filename, max_bytes = 0, max_age = 0, backups = 0):
+        self.filename = filename
+        self.lock_name = filename + '.lock'
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backups = backups
+        self.rotated = self.last_rotation()
+        self.open()
+
+    def open(self):
+        self.file = open(self.filename, 'a')
+
+    def last_rotation(self):
+        try:
+            return os.stat(self.lock_name).st_mtime
+        except OSError:
+            # Nothing rotated the file yet, start counting now.
+            open(self.lock_name, 'a').close()
+            return time.time()
+
+    def write(self, data):
+        self.check()
+        self.file.write(data)
+        self.file.flush()
+
+    def due(self, stats):
+        """Return whether the file described by stats should be rotated."""
+        if stats.st_size == 0:
+            return False
+        if self.max_bytes and stats.st_size >= self.max_bytes:
+            return True
+        if self.max_age and time.time() - self.rotated >= self.max_age:
+            # Another process may have rotated the file meanwhile.
+            self.rotated = self.last_rotation()
+            return time.time() - self.rotated >= self.max_age
+        return False
+
+    def check(self):
+        """Rotate the file if it is due, or reopen it if another process
+        has rotated it."""
+        stats = os.fstat(self.file.fileno())
+        try:
+            current = os.stat(self.filename)
+        except OSError:
+            current = None
+        if current is None or current.st_ino != stats.st_ino:
+            self.file.close()
+            self.open()
+            return
+        if not self.due(stats):
+            return
+        lock = open(self.lock_name, 'a')
+        try:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # Another process is rotating the file right now.
+                return
+            # Check again under the lock as the file may have been rotated
+            # since it was checked above.
+            current = os.stat(self.filename)
+            if current.st_ino == stats.st_ino and self.due(current):
+                self.rollover()
+                os.utime(self.lock_name, None)
+                self.rotated = time.time()
+            self.file.close()
+            self.open()
+        finally:
+            # Closing the file releases the lock.
+            lock.close()
+
+    def rollover(self):
+        for i in range(self.backups - 1, 0, -1):
+            backup = '%s.%d' % (self.filename, i)
+            if os.path.exists(backup):
+                os.rename(backup, '%s.%d' % (self.filename, i + 1))
+        if self.backups:
+            os.rename(self.filename, self.filename + '.1')
+        else:
+            os.unlink(self.filename)
+
+class AsyncLog:
+    """
+    Callable used as log(client, package, event, type, message, *args,
+    bytes = None, latency = None), writing to a RotatingLogFile.
+    The record is dropped right away if the level of event is below level.
+    Otherwise message % args is formatted by the writer thread. Events
+    without a level in event_levels are logged at info level, or at error
+    level if they end with _ERR. bytes and latency, in seconds, appear only
+    in the JSON records.
+    """
+    def __init__(self, filename, level = levels['info'], event_levels = {}, max_bytes = 0, max_age = 0, backups = 0, json = False, max_queued = 10000, batch = 256):
+        self.filename = filename
+        self.json = json
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backups = backups
+        self.level = level
+        self.event_levels = event_levels
+        self.max_queued = max_queued
+        self.batch = batch
+        self.pid = None
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def start(self):
+        """Start the writer thread of this process."""
+        self.pid = os.getpid()
+        self.records = Queue.Queue(self.max_queued)
+        self.dropped = 0
+        self.file = RotatingLogFile(self.filename, self.max_bytes, self.max_age, self.backups)
+        self.writer = threading.Thread(target = self.write)
+        self.writer.setDaemon(True)
+        self.writer.start()
+
+    def after_fork(self):
+        """Call in a child forked while another thread may hold the lock.
+        The writer thread of the child is started by its first record."""
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def event_level(self, event):
+        if event in self.event_levels:
+            return self.event_levels[event]
+        if event.endswith('_ERR'):
+            return levels['error']
+        return levels['info']
+
+    def __call__(self, client, package, event, type, message, *args, **fields):
+        level = self.event_level(event)
+        if level < self.level:
+            return
+        if self.pid != os.getpid():
+            # The writer thread doesn't survive a fork.
+            self.lock.acquire()
+            try:
+                if self.pid != os.getpid():
+                    self.start()
+            finally:
+                self.lock.release()
+        try:
+            self.records.put_nowait((time.time(), level, client, package, event, type, message, args, fields))
+        except Queue.Full:
+            # Never block the caller. The writer reports the loss.
+            self.dropped += 1
+
+    def format(self, record):
+        (created, level, client, package, event, type, message, args, fields) = record
+        if args:
+            message = message % args
+        if self.json:
+            values = [('time', created), ('level', names[level].upper()), ('client', client), ('package', package), ('type', type), ('event', event), ('bytes', fields.get('bytes')), ('latency', fields.get('latency')), ('message', message)]
+            return '{' + ', '.join(['"%s": %s' % (name, json_value(value)) for (name, value) in values]) + '}\n'
+        msecs = int((created - int(created)) * 1000)
+        asctime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created)) + ',%03d' % msecs
+        return '%s %s %s %s %s %s %s\n' % (asctime, names[level].upper(), client, package, event, type, message)
+
+    def write(self):
+        """Main loop of the writer thread."""
+        while True:
+            records = [self.records.get()]
+            try:
+                while len(records) < self.batch:
+                    records.append(self.records.get_nowait())
+            except Queue.Empty:
+                pass
+            lines = []
+            for record in records:
+                if record is None:
+                    self.file.write(''.join(lines))
+                    return
+                try:
+                    lines.append(self.format(record))
+                except:
+                    pass
+            if self.dropped:
+                lines.append(self.format((time.time(), levels['warning'], '-', '-', 'LOG_DROPPED', '-', '%d log records were dropped.', (self.dropped,), {})))
+                self.dropped = 0
+            try:
+                self.file.write(''.join(lines))
+            except (IOError, OSError):
+                pass
+
+    def close(self, timeout = 5):
+        """Write the queued records before the process exits."""
+        if self.pid != os.getpid():
+            return
+        self.pid = None
+        try:
+            self.records.put(None, True, timeout)
+        except Queue.Full:
+            pass
+        self.writer.join(timeout)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# (C) Copyright 2008 Kulbir Saini <kulbirsaini@students.iiit.ac.in>
+#
+
+"""
+Mapping of package urls to canonical keys. Mirrors of a distribution keep
+the same directory layout below a common marker, e.g. /fedora/linux/ or
+/debian/, so the part of the path following the marker identifies a
+package regardless of the mirror it was fetched from.
+"""
+
+__author__ = """Kulbir Saini <kulbirsaini@students.iiit.ac.in>"""
+__docformat__ = 'plaintext'
+
+import posixpath
+import re
+
+# Query parameter added to the urls on which the stream server sends clients
+# upstream, so that the rewriter doesn't send them to the stream server again.
+upstream_marker = 'intelligentmirror=upstream'
+
+def parse_rules(text):
+    """Parse whitespace separated distro:marker pairs into a list of
+    (distro, marker). Raises ValueError for a malformed rule."""
+    rules = []
+    for rule in text.split():
+        (distro, marker) = rule.split(':', 1)
+        if not distro or not marker:
+            raise ValueError('invalid mirror rule "%s"' % rule)
+        rules.append((distro, '/' + marker.strip('/') + '/'))
+    return rules
+
+class Canonicalizer:
+    """
+    Map the host and path of a package url to a key relative to the cache
+    directory. Paths containing the marker of a rule map to
+    <distro>/<path after the marker>. Other paths map to <host>/<path>, so
+    unrelated packages with the same name don't collide. The host of a file
+    url like file:///path is localhost.
+    """
+    def __init__(self, rules):
+        self.distros = [distro for (distro, marker) in rules]
+        # One alternation finds the leftmost marker of any rule in a single
+        # scan of the path.
+        if rules:
+            self.pattern = re.compile('|'.join(['(%s)' % re.escape(marker) for (distro, marker) in rules]))
+        else:
+            self.pattern = None
+
+    def key(self, host, path):
+        """Return the key for the package at path on host, or None if path
+        can't be used as a key."""
+        match = None
+        if self.pattern is not None:
+            match = self.pattern.search(path)
+        if match is not None:
+            key = self.distros[match.lastindex - 1] + '/' + path[match.end():]
+        else:
+            key = (host.split(':')[0].lower() or 'localhost') + '/' + path.lstrip('/')
+        return safe_key(key)
+
+def mark_upstream(url):
+    """Return url with upstream_marker added."""
+    if '?' in url:
+        return url + '&' + upstream_marker
+    return url + '?' + upstream_marker
+
+def unmark_upstream(url):
+    """Return url without the upstream_marker added by mark_upstream(), or
+    None if url isn't marked."""
+    for separator in ('?', '&'):
+        if url.endswith(separator + upstream_marker):
+            return url[:-len(separator + upstream_marker)]
+    return None
+
+def safe_key(key):
+    """Return key normalized, or None if it would point outside of the
+    cache directory."""
+    key = posixpath.normpath(key)
+    if key.startswith('/') or key == '..' or key.startswith('../'):
+        return None
+    if posixpath.basename(key) in ('', '.'):
+        return None
+    return key
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# (C) Copyright 2008 Kulbir Saini <kulbirsaini@students.iiit.ac.in>
+#
+
+"""
+Catalogue of the cached packages. The catalogue is kept in memory and
+every change is appended to a log file, which is replayed at startup.
+The log is rewritten once it has grown much larger than the catalogue.
+Once start() is called, hits are written to the log by a thread every few
+seconds rather than one at a time, so the hits of the last seconds are
+lost if the process is killed.
+"""
+
+__author__ = """Kulbir Saini <kulbirsaini@students.iiit.ac.in>"""
+__docformat__ = 'plaintext'
+
+import os
+import threading
+import time
+
+# Indices in a catalogue entry.
+SIZE = 0
+DIGEST = 1
+INSERTED = 2
+LAST_HIT = 3
+HITS = 4
+
+class Catalogue:
+    """
+    Map of type -> package -> [size, digest, insert time, last hit time,
+    hits]. Sizes are in bytes. The log holds one record per line:
+      A type package size digest inserted last_hit hits   (add or replace)
+      H type package time                                 (hit)
+      D type package                                      (delete)
+    with the fields separated by tabs.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.records = 0
+        # Map of type -> packages changed since watch() for 'type'.
+        self.watched = {}
+        # Hit records not written yet, see start().
+        self.pending = []
+        self.flusher = None
+        # lock guards the entries once start() is called, log_lock the log.
+        self.lock = threading.RLock()
+        self.log_lock = threading.Lock()
+        # Whether there was no log to load, e.g. on the first start.
+        self.fresh = not os.path.exists(path)
+        if not self.fresh:
+            self.load()
+        self.log = open(path, 'a')
+
+    def load(self):
+        file = open(self.path)
+        try:
+            for line in file:
+                try:
+                    self.replay(line.rstrip('\n').split('\t'))
+                    self.records += 1
+                except (ValueError, IndexError, KeyError):
+                    # A record cut short by a crash.
+                    continue
+        finally:
+            file.close()
+
+    def replay(self, fields):
+        op = fields[0]
+        if op == 'A':
+            entry = [int(fields[3]), fields[4], float(fields[5]), float(fields[6]), int(fields[7])]
+            self.entries.setdefault(fields[1], {})[fields[2]] = entry
+        elif op == 'H':
+            entry = self.entries[fields[1]][fields[2]]
+            entry[LAST_HIT] = float(fields[3])
+            entry[HITS] += 1
+        elif op == 'D':
+            self.entries[fields[1]].pop(fields[2])
+        else:
+            raise ValueError(op)
+
+    def start(self, lock, interval):
+        """Write the hits from a thread every interval seconds, which also
+        rewrites the log when needed. lock must be held by the callers of the
+        other methods, and is taken by the thread to copy the entries."""
+        self.lock = lock
+        self.interval = interval
+        self.flusher = threading.Thread(target = self.flush_forever)
+        self.flusher.setDaemon(True)
+        self.flusher.start()
+
+    def flush_forever(self):
+        """Main loop of the flusher thread."""
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+                if self.oversized():
+                    self.compact()
+            except (IOError, OSError):
+                pass
+
+    def take_pending(self):
+        # A hit recorded while the list is swapped is appended to the list
+        # returned, never lost.
+        (lines, self.pending) = (self.pending, [])
+        return lines
+
+    def append(self, lines):
+        self.log.write(''.join(lines))
+        self.log.flush()
+        self.records += len(lines)
+
+    def flush(self):
+        """Write the pending hits to the log."""
+        self.log_lock.acquire()
+        try:
+            lines = self.take_pending()
+            if lines:
+                self.append(lines)
+        finally:
+            self.log_lock.release()
+
+    def oversized(self):
+        return self.records > 2 * len(self) + 10000
+
+    def write(self, fields):
+        line = '\t'.join([str(field) for field in fields]) + '\n'
+        self.log_lock.acquire()
+        try:
+            # The pending hits go first, so they are replayed in order.
+            self.append(self.take_pending() + [line])
+        finally:
+            self.log_lock.release()
+        if self.flusher is None and self.oversized():
+            self.compact()
+
+    def watch(self, type):
+        """Start recording the packages of 'type' which are added, hit or
+        removed, until unwatch()."""
+        self.watched[type] = {}
+
+    def unwatch(self, type):
+        """Return the dictionary of the packages of 'type' changed since
+        watch(), empty if 'type' wasn't watched."""
+        return self.watched.pop(type, {})
+
+    def touch(self, type, package):
+        if type in self.watched:
+            self.watched[type][package] = True
+
+    def __len__(self):
+        return sum([len(packages) for packages in self.entries.values()])
+
+    def add(self, type, package, size, digest):
+        """Add package of 'type' or replace it if it is present."""
+        entry = [size, digest, time.time(), 0.0, 0]
+        self.entries.setdefault(type, {})[package] = entry
+        self.touch(type, package)
+        self.write(['A', type, package] + entry)
+
+    def hit(self, type, package):
+        """Record a hit for package of 'type'. Returns whether it is present."""
+        entry = self.entries.get(type, {}).get(package)
+        if entry is None:
+            return False
+        entry[LAST_HIT] = time.time()
+        entry[HITS] += 1
+        self.touch(type, package)
+        fields = ['H', type, package, entry[LAST_HIT]]
+        if self.flusher is None:
+            self.write(fields)
+        else:
+            self.pending.append('\t'.join([str(field) for field in fields]) + '\n')
+        return True
+
+    def remove(self, type, package):
+        """Remove package of 'type' if present."""
+        if package in self.entries.get(type, {}):
+            self.entries[type].pop(package)
+            self.touch(type, package)
+            self.write(['D', type, package])
+
+    def get(self, type):
+        """Return a dictionary of package -> entry for 'type'."""
+        return self.entries.get(type, {})
+
+    def compact(self):
+        """Rewrite the log with one record per package. The entries are
+        copied under lock and written without it. Changes wait for the log
+        to be rewritten."""
+        self.lock.acquire()
+        try:
+            self.log_lock.acquire()
+            # The pending hits are part of the entries copied.
+            self.pending = []
+            lines = []
+            for (type, packages) in self.entries.items():
+                for (package, entry) in packages.items():
+                    lines.append('\t'.join([str(field) for field in ['A', type, package] + entry]) + '\n')
+        finally:
+            self.lock.release()
+        try:
+            temp = self.path + '.new'
+            file = open(temp, 'w')
+            try:
+                file.write(''.join(lines))
+            finally:
+                file.close()
+            os.rename(temp, self.path)
+            self.log.close()
+            self.log = open(self.path, 'a')
+            self.records = len(lines)
+        finally:
+            self.log_lock.release()
@@ -24,14 +24,17 @@ Configuration parser and default values for yum.
 
 import os
 import warnings
-import rpm
 import copy
 import urlparse
 from parser import ConfigPreProcessor
-from iniparse.compat import NoSectionError, NoOptionError, ConfigParser
-from iniparse.compat import ParsingError
-import rpmUtils.transaction
-import rpmUtils.arch
+try:
+    from iniparse.compat import NoSectionError, NoOptionError, ConfigParser
+    from iniparse.compat import ParsingError
+except ImportError:
+    # iniparse only keeps the comments when the configuration is written
+    # back, which intelligentmirror never does.
+    from ConfigParser import NoSectionError, NoOptionError, ConfigParser
+    from ConfigParser import ParsingError
 import Errors
 
 class Option(object):
@@ -575,16 +578,38 @@ class YumConf(StartupConf):
     # Global Options
     base_dir = Option('/var/spool/squid/intelligentmirror/')
     temp_dir = Option('tmp')
+    blob_dir = Option('blobs')
+    catalogue_file = Option('catalogue')
+    pool_file = Option('pool')
     max_parallel_downloads = Option(30)
     cache_host = Option('127.0.0.1')
-    rpc_host = Option('127.0.0.1')
-    rpc_port = Option(9000)
+    rpc_socket = Option('/var/spool/squid/intelligentmirror.sock')
     logfile = Option('/var/spool/squid/intelligentmirror.log')
     max_logfile_size = Option(10)
     max_logfile_backups = Option(10)
+    max_logfile_age = Option(24)
+    log_level = SelectionOption('info', ('debug', 'info', 'warning', 'error'))
+    log_levels = Option('')
+    log_format = SelectionOption('text', ('text', 'json'))
     proxy = Option('http://127.0.0.1:3128')
     proxy_username = Option()
     proxy_password = Option()
+    url_rewrite_concurrency = Option(0)
+    cache_size_reconcile_interval = Option(600)
+    eviction_policy = SelectionOption('lru', ('lru', 'lfu', 'gdsf'))
+    eviction_interval = Option(60)
+    cache_high_watermark = Option(95)
+    cache_low_watermark = Option(85)
+    download_retries = Option(3)
+    download_retry_delay = Option(5)
+    partial_max_age = Option(24)
+    stream_port = Option(0)
+    stream_wait = Option(10)
+    metrics_port = Option(0)
+    mirror_rules = Option('fedora:fedora/linux epel:epel centos:centos debian:debian ubuntu:ubuntu')
+    prefetch_repos = Option('')
+    prefetch_hours = Option('1-6')
+    prefetch_interval = Option(3600)
 
     # RPM related config
     enable_rpm_cache = Option(1)
@@ -629,6 +654,7 @@ def readStartupConfig(configfile, root):
 
     # Stuff this here to avoid later re-parsing
     startupconf._parser = parser
+    startupconf._included = confpp_obj.included()
 
     return startupconf
 
@@ -645,7 +671,7 @@ def readMainConfig(startupconf):
     yumconf.populate(startupconf._parser, 'main')
 
     # Apply the installroot to directory options
-    for option in ('base_dir', 'logfile'):
+    for option in ('base_dir', 'logfile', 'rpc_socket'):
         path = getattr(yumconf, option)
         setattr(yumconf, option, yumconf.installroot + path)
     
@@ -655,6 +681,7 @@ def readMainConfig(startupconf):
         yumconf.config_file_age = os.stat(startupconf.config_file_path)[8]
     else:
         yumconf.config_file_age = 0
+    yumconf.config_file_urls = startupconf._included
     
     # propagate the debuglevel and errorlevel values:
     yumconf.debuglevel = startupconf.debuglevel
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# (C) Copyright 2008 Kulbir Saini <kulbirsaini@students.iiit.ac.in>
+#
+
+"""
+Cache eviction policies. Every policy assigns a priority to each cached
+package and the packages with the lowest priority are evicted first.
+"""
+
+__author__ = """Kulbir Saini <kulbirsaini@students.iiit.ac.in>"""
+__docformat__ = 'plaintext'
+
+class EvictionPolicy:
+    """
+    Base class for eviction policies. Subclasses must override priority().
+    A policy instance lives as long as the evictor, so policies can keep
+    state across eviction runs.
+    """
+    def priority(self, name, size, hits, atime):
+        """Return the priority of package 'name' of 'size' bytes which has
+        been served 'hits' times and was last accessed at 'atime'."""
+        raise NotImplementedError
+
+    def evicted(self, name, priority):
+        """Called for every package which is evicted."""
+        return
+
+    def select(self, entries, excess):
+        """
+        Return the names of the packages to evict so that at least 'excess'
+        bytes are freed. 'entries' is a list of (name, size, hits, atime,
+        blob). Packages with the same blob, unless it is None, share their
+        space, which is freed once the last of them is evicted.
+        """
+        candidates = [(self.priority(name, size, hits, atime), name, size, blob) for (name, size, hits, atime, blob) in entries]
+        candidates.sort()
+        # Map of blob -> number of packages sharing it.
+        links = {}
+        for (name, size, hits, atime, blob) in entries:
+            links[blob] = links.get(blob, 0) + 1
+        victims = []
+        freed = 0
+        for (priority, name, size, blob) in candidates:
+            if freed >= excess:
+                break
+            victims.append(name)
+            if blob is None:
+                freed += size
+            else:
+                links[blob] -= 1
+                if links[blob] == 0:
+                    freed += size
+            self.evicted(name, priority)
+        return victims
+
+class LRUPolicy(EvictionPolicy):
+    """Evict the least recently used packages first."""
+    def priority(self, name, size, hits, atime):
+        return atime
+
+class LFUPolicy(EvictionPolicy):
+    """Evict the least frequently used packages first. Ties are broken by
+    evicting the least recently used package."""
+    def priority(self, name, size, hits, atime):
+        return (hits, atime)
+
+class GDSFPolicy(EvictionPolicy):
+    """
+    Greedy Dual Size Frequency. Small and frequently used packages are kept
+    in preference to large and rarely used ones. A package's priority is
+    fixed when it is accessed, relative to the inflation value at that time.
+    The inflation value is raised to the priority of every evicted package,
+    so packages which were popular long ago eventually age out.
+    """
+    def __init__(self):
+        self.inflation = 0.0
+        # Map of package name to (atime, priority).
+        self.credits = {}
+
+    def priority(self, name, size, hits, atime):
+        credit = self.credits.get(name)
+        if credit is None or credit[0] != atime:
+            credit = (atime, self.inflation + float(hits + 1) / max(size, 1))
+            self.credits[name] = credit
+        return credit[1]
+
+    def evicted(self, name, priority):
+        if priority > self.inflation:
+            self.inflation = priority
+        if name in self.credits:
+            self.credits.pop(name)
+        return
+
+    def select(self, entries, excess):
+        # Forget the packages which have disappeared since the last run.
+        names = dict([(entry[0], True) for entry in entries])
+        for name in self.credits.keys():
+            if name not in names:
+                self.credits.pop(name)
+        return EvictionPolicy.select(self, entries, excess)
+
+policies = {
+    'lru' : LRUPolicy,
+    'lfu' : LFUPolicy,
+    'gdsf' : GDSFPolicy,
+}
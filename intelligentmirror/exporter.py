@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# (C) Copyright 2008 Kulbir Saini <kulbirsaini@students.iiit.ac.in>
+#
+
+"""
+HTTP server exporting the metrics kept by PackagePool. It is kept apart
+from metrics so that the instances answering squid don't load the HTTP
+server modules.
+"""
+
+__author__ = """Kulbir Saini <kulbirsaini@students.iiit.ac.in>"""
+__docformat__ = 'plaintext'
+
+from metrics import prometheus, to_json
+import BaseHTTPServer
+import SocketServer
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve GET /metrics in the Prometheus text format and GET /metrics.json."""
+    def do_GET(self):
+        if self.path == '/metrics':
+            content_type = 'text/plain; version=0.0.4'
+            render = prometheus
+        elif self.path == '/metrics.json':
+            content_type = 'application/json'
+            render = to_json
+        else:
+            self.send_error(404)
+            return
+        try:
+            (counters, histograms, gauges) = self.server.package_pool.get_metrics()
+            body = render(counters, histograms, gauges)
+        except Exception, e:
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # stderr of intelligentmirror goes to squid's cache.log.
+        return
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serve the metrics kept by package_pool on address."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, package_pool):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MetricsRequestHandler)
+        self.package_pool = package_pool
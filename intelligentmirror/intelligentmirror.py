@@ -20,46 +20,104 @@
 __author__ = """Kulbir Saini <kulbirsaini@students.iiit.ac.in>"""
 __docformat__ = 'plaintext'
 
-from config import readMainConfig, readStartupConfig
-import logging
-import logging.handlers
+from canonical import Canonicalizer, parse_rules, safe_key, unmark_upstream
+from asynclog import AsyncLog, levels, parse_levels
+from catalogue import Catalogue, SIZE, DIGEST, INSERTED, LAST_HIT, HITS
+from eviction import policies
+from metrics import Metrics
+from pqueue import PriorityQueue
+from prefetch import compare_versions, deb_file, in_hours, newest_packages, parse_hours, parse_repos, repo_packages, rpm_file
+from rpc import PoolProxy, PoolServer
+from snapshot import read_config
+from store import BlobStore, hash_file, make_dirs, new_digest
+from workers import WorkerPool
+import errno
+import fcntl
+import marshal
 import os
-import random
+import Queue
+import signal
 import stat
 import sys
 import threading
 import time
-import urlgrabber
 import urlparse
-from xmlrpclib import ServerProxy
-from SimpleXMLRPCServer import SimpleXMLRPCServer
 
 # To modify configuration parameters, see /etc/intelligentmirror.conf .
-# Read config file using Yum's config parsers.
-mainconf = readMainConfig(readStartupConfig('/etc/intelligentmirror.conf', '/'))
+# INTELLIGENTMIRROR_CONF names another file, e.g. for the benchmarks.
+config_file = os.environ.get('INTELLIGENTMIRROR_CONF', '/etc/intelligentmirror.conf')
+# Read config file using Yum's config parsers, or its snapshot if it didn't
+# change since it was last parsed.
+mainconf = read_config(config_file)
 
 # Global Options
 base_dir = mainconf.base_dir
 temp_dir = os.path.join(base_dir, mainconf.temp_dir)
+blob_dir = os.path.join(base_dir, mainconf.blob_dir)
+catalogue_file = os.path.join(base_dir, mainconf.catalogue_file)
+pool_file = os.path.join(base_dir, mainconf.pool_file)
 max_parallel_downloads = int(mainconf.max_parallel_downloads)
 cache_host =  mainconf.cache_host
-rpc_host = mainconf.rpc_host
-rpc_port = int(mainconf.rpc_port)
+rpc_socket = mainconf.rpc_socket
 logfile = mainconf.logfile
 max_logfile_size = int(mainconf.max_logfile_size) * 1024 * 1024
 max_logfile_backups = int(mainconf.max_logfile_backups)
+max_logfile_age = int(mainconf.max_logfile_age) * 3600
+log_level = mainconf.log_level
+log_levels = parse_levels(mainconf.log_levels)
+log_format = mainconf.log_format
 proxy = mainconf.proxy
 proxy_username = mainconf.proxy_username
 proxy_password = mainconf.proxy_password
+url_rewrite_concurrency = int(mainconf.url_rewrite_concurrency)
+cache_size_reconcile_interval = int(mainconf.cache_size_reconcile_interval)
+eviction_policy = mainconf.eviction_policy
+eviction_interval = int(mainconf.eviction_interval)
+cache_high_watermark = int(mainconf.cache_high_watermark)
+cache_low_watermark = int(mainconf.cache_low_watermark)
+download_retries = int(mainconf.download_retries)
+download_retry_delay = int(mainconf.download_retry_delay)
+partial_max_age = int(mainconf.partial_max_age) * 3600
+stream_port = int(mainconf.stream_port)
+stream_wait = int(mainconf.stream_wait)
+metrics_port = int(mainconf.metrics_port)
+mirror_rules = parse_rules(mainconf.mirror_rules)
+prefetch_repos = parse_repos(mainconf.prefetch_repos)
+prefetch_hours = parse_hours(mainconf.prefetch_hours)
+prefetch_interval = int(mainconf.prefetch_interval)
 
 BASE_PLUGIN = 0
-XMLRPC_SERVER = 1
+RPC_SERVER = 1
 DOWNLOAD_SCHEDULER = 2
+CACHE_SIZE_RECONCILER = 3
+CACHE_EVICTOR = 4
+STREAM_SERVER = 5
+PREFETCHER = 6
+METRICS_SERVER = 7
 rpm_files = ['.rpm']
 deb_files = ['.deb']
 redirect = '303'
-format = '%s %s %s %s %s'
+download_block_size = 64 * 1024
 cache_url = 'http://' + str(cache_host) + '/' 
+stdout_lock = threading.Lock()
+store = BlobStore(blob_dir)
+canonicalizer = Canonicalizer(mirror_rules)
+metrics = Metrics()
+# Interval at which the metrics of a process are merged into PackagePool.
+metrics_flush_interval = 5
+metrics_flushed = 0
+# Interval at which the queue and the active downloads are saved to pool_file.
+pool_save_interval = 10
+# Interval at which a process checks whether stream_server() is up.
+stream_check_interval = 5
+stream_checked = 0
+stream_up = False
+# Interval at which the hits are written to catalogue_file.
+catalogue_flush_interval = 2
+# The lock held by the leader, None in the other instances. See elect_leader().
+leader_lock = None
+# Set once the RPC server of the leader accepts connections.
+rpc_started = threading.Event()
 
 
 # RPM related variables.
@@ -83,62 +141,152 @@ def set_proxy():
         new_proxy = '%s://%s:%s@%s/' % (proxy_parts[0], proxy_username, proxy_password, proxy_parts[1])
     else:
         new_proxy = proxy
+    # Only the instance downloading packages needs urlgrabber.
+    import urlgrabber.grabber
     return urlgrabber.grabber.URLGrabber(proxies = {'http': new_proxy, 'https': new_proxy, 'ftp': new_proxy})
 
 def set_logging():
-    logging.basicConfig(level=logging.DEBUG,
-                        format='%(asctime)s %(levelname)s %(message)s',
-                        filename=logfile,
-                        filemode='a')
-    return logging.info
+    """Return the function used to log, log(client, package, event, type, message)."""
+    return AsyncLog(logfile, levels[log_level], log_levels, max_logfile_size, max_logfile_age, max_logfile_backups, log_format == 'json')
 
 def dir_size(dir):
     """
     This is not a standard function to calculate the size of a directory.
-    This function will only give the sum of sizes of all the files in 'dir'.
+    This function will only give the sum of sizes of all the files in 'dir'
+    in kilo bytes. Files linked under several names are counted once.
     """
     # Initialize with 4096bytes as the size of an empty dir is 4096bytes.
     size = 4096
+    inodes = {}
     try:
-        for file in os.listdir(dir):
-            size += int(os.stat(os.path.join(dir, file))[6])
+        for file in cached_packages(dir):
+            stats = os.stat(os.path.join(dir, file))
+            if stats[stat.ST_INO] not in inodes:
+                inodes[stats[stat.ST_INO]] = True
+                size += int(stats[stat.ST_SIZE])
     except:
         return -1
-    return size / (1024*1024)
+    return size / 1024
+
+def cached_packages(dir):
+    """Return the paths of all the files below dir, relative to dir."""
+    files = []
+    for (root, dirs, names) in os.walk(dir):
+        prefix = root[len(dir):].strip('/')
+        for name in names:
+            files.append(os.path.join(prefix, name))
+    return files
+
+def partial_path(package):
+    """Return the path at which package is downloaded in temp_dir."""
+    # urllib is imported when needed as it loads the ssl module.
+    import urllib
+    return os.path.join(temp_dir, urllib.quote(package, ''))
+
+def scan_packages(dir):
+    """Return a dictionary of package -> size in bytes of the packages
+    below dir, or None if dir could not be scanned."""
+    packages = {}
+    try:
+        for package in cached_packages(dir):
+            # Skip the links being put in place by BlobStore.add().
+            if package.endswith('.link'):
+                continue
+            packages[package] = os.stat(os.path.join(dir, package))[stat.ST_SIZE]
+    except OSError:
+        return None
+    return packages
+
+def cache_dirs():
+    """Return (type, cache_dir) for the enabled cache directories."""
+    dirs = []
+    if enable_rpm_cache:
+        dirs.append(('RPM', rpm_cache_dir))
+    if enable_deb_cache:
+        dirs.append(('DEB', deb_cache_dir))
+    return dirs
+
+def sized_cache_dirs():
+    """Return (type, cache_dir, cache_size) for the cache directories having a size limit."""
+    dirs = []
+    if enable_rpm_cache and rpm_cache_size:
+        dirs.append(('RPM', rpm_cache_dir, rpm_cache_size))
+    if enable_deb_cache and deb_cache_size:
+        dirs.append(('DEB', deb_cache_dir, deb_cache_size))
+    return dirs
 
 class PackagePool:
     """
     This class is for sharing the current packages being downloading
-    across various instances of intelligentmirror via XMLRPC.
+    across various instances of intelligentmirror via PoolServer. It also
+    holds the catalogue of the cached packages.
     """
-    def __init__(self):
-        self.scores = {}
+    def __init__(self, catalogue):
+        self.scores = PriorityQueue()
         self.queue = {}
-        self.active = []
+        # Map of active package to [pid of the worker, start time, size].
+        self.active = {}
+        self.cache_sizes = {}
+        self.catalogue = catalogue
+        self.metrics = Metrics()
+        # PoolServer serializes calls with lock. work is used to wake up
+        # download_scheduler() when there is something to schedule.
+        self.lock = threading.RLock()
+        self.work = threading.Condition(self.lock)
+        self.pending = False
+        # Whether stream_server() is up.
+        self.streaming = False
         pass
 
+    def wake(self):
+        """Wake up the download scheduler waiting in wait_for_work()."""
+        self.work.acquire()
+        self.pending = True
+        self.work.notify()
+        self.work.release()
+
     # Functions related to package queue-ing.
     def add(self, package, score = 1):
         """Queue a package for download. Score defaults to one."""
-        if package not in self.queue.keys():
+        if package not in self.queue:
             self.queue[package] = []
-        self.scores[package] = score
+        self.scores.set(package, score)
         return True
 
     def set(self, package, values):
         """Set the details of package to values."""
         self.queue[package] = values
+        self.wake()
         return True
 
     def set_score(self, package, score = 1):
         """Set the priority score of a package."""
-        self.scores[package] = score
+        self.scores.set(package, score)
         return True
 
     def inc_score(self, package, incr = 1):
         """Increase the priority score of package represented by 'package'."""
-        if package in self.scores.keys():
-            self.scores[package] += incr
+        if package in self.scores:
+            self.scores.inc(package, incr)
+        return True
+
+    def add_or_inc_score(self, package):
+        """Increase the priority score of package if it is queued already,
+        otherwise queue it. Returns whether package was queued already."""
+        if package in self.queue:
+            self.inc_score(package)
+            return True
+        self.add(package)
+        return False
+
+    def prefetch(self, package, values):
+        """Queue package with the lowest score and its details set to values,
+        unless it is queued already. Returns whether package was queued."""
+        if package in self.queue or package in self.active:
+            return False
+        self.queue[package] = values
+        self.scores.set(package, 0)
+        self.wake()
         return True
 
     def get(self):
@@ -147,45 +295,106 @@ class PackagePool:
 
     def get_details(self, package):
         """Return the details of a particular package represented by 'package'."""
-        if package in self.queue.keys():
+        if package in self.queue:
             return self.queue[package]
         return False
 
     def get_popular(self):
         """Return the most frequently accessed package."""
-        vk = [(v,k) for k,v in self.scores.items()]
-        if len(vk) != 0:
-            package = sorted(vk, reverse=True)[0][1]
+        package = self.scores.peek()
+        if package is not None:
             return package
         return "NULL"
 
     def remove(self, package):
         """Dequeue a package from the download queue."""
-        if package in self.queue.keys():
+        if package in self.queue:
             self.queue.pop(package)
-        if package in self.scores.keys():
-            self.scores.pop(package)
+        if package in self.scores:
+            self.scores.remove(package)
         return True
 
     def flush(self):
-        """Flush the queue and reinitialize everything."""
+        """Flush the queue and reinitialize everything.
+        Cache sizes are left alone as they describe the disk, not the queue."""
         self.queue = {}
-        self.scores = {}
-        self.active = []
+        self.scores = PriorityQueue()
+        self.active = {}
         return True
 
+    def save(self, path):
+        """Save the queue, the scores and the active downloads to path, for
+        the next instance running PoolServer to restore()."""
+        # The flusher of the catalogue doesn't outlive the instance.
+        self.catalogue.flush()
+        temp = path + '.new'
+        file = open(temp, 'wb')
+        try:
+            scores = dict([(package, self.scores.get(package)) for package in self.scores.keys()])
+            marshal.dump((self.queue, scores, self.active), file)
+        finally:
+            file.close()
+        os.rename(temp, path)
+        return True
+
+    def restore(self, path):
+        """Load the state saved by save() to path, if any. The active
+        downloads are kept as they may still be running in the workers of
+        the previous instance, see reap_conns(). Returns the number of
+        packages queued and active."""
+        try:
+            file = open(path, 'rb')
+        except IOError:
+            return (0, 0)
+        try:
+            try:
+                (queue, scores, active) = marshal.load(file)
+            except (EOFError, ValueError, TypeError):
+                return (0, 0)
+        finally:
+            file.close()
+        self.queue.update(queue)
+        for (package, score) in scores.items():
+            self.scores.set(package, score)
+        self.active.update(active)
+        self.wake()
+        return (len(scores), len(active))
+
     # Functions related download scheduling.
-    # Have to mess up things in single class because python
-    # XMLRPCServer doesn't allow to register multiple instances
-    # via register_instance
+    # Have to mess up things in single class because PoolServer
+    # serves a single instance.
     def add_conn(self, package):
         """Add package to active connections list."""
         if package not in self.active:
-            self.active.append(package)
+            self.active[package] = [0, time.time(), "NULL"]
+        return True
+
+    def set_conn_worker(self, package, pid):
+        """Record the pid of the worker downloading package."""
+        if package in self.active:
+            self.active[package][0] = pid
         return True
 
+    def set_conn_size(self, package, size):
+        """Record the size of package once its download has started writing
+        to temp_dir. size is -1 if the size is not known."""
+        if package in self.active:
+            self.active[package][2] = size
+        return True
+
+    def get_conn_size(self, package):
+        """Return the size of package if its download has started writing to
+        temp_dir, otherwise "NULL"."""
+        if package in self.active:
+            return self.active[package][2]
+        return "NULL"
+
     def get_conn(self):
         """Return a list of currently active connections."""
+        return self.active.keys()
+
+    def get_conn_details(self):
+        """Return a dictionary of active package -> [pid of the worker, start time, size]."""
         return self.active
 
     def get_conn_number(self):
@@ -201,14 +410,232 @@ class PackagePool:
     def remove_conn(self, package):
         """Remove package from active connections list."""
         if package in self.active:
-            self.active.remove(package)
+            self.active.pop(package)
+            self.wake()
+        return True
+
+    def cancel(self, package):
+        """Cancel the download of package by killing its worker. Returns
+        whether there was a download to cancel."""
+        if package in self.active and self.active[package][0]:
+            try:
+                os.kill(self.active[package][0], signal.SIGTERM)
+            except OSError:
+                return False
+            # download_scheduler() will reap the worker.
+            self.wake()
+            return True
+        return False
+
+    def reap_conns(self, pids):
+        """
+        Free the connections of the active packages whose worker is not one
+        of pids, i.e. was started by a previous instance, and has exited. The
+        packages are queued again if their details are known. Returns the
+        list of (pid, package) for the connections freed.
+        """
+        reaped = []
+        for (package, details) in self.active.items():
+            pid = details[0]
+            if pid in pids:
+                continue
+            if pid > 0:
+                try:
+                    os.kill(pid, 0)
+                    continue
+                except OSError, e:
+                    if e.errno != errno.ESRCH:
+                        continue
+            self.active.pop(package)
+            if self.queue.get(package):
+                self.scores.set(package, 1)
+            else:
+                self.remove(package)
+            reaped.append((pid, package))
+        if reaped:
+            self.wake()
+        return reaped
+
+    def next_download(self, max_conn):
+        """
+        Return the details of the most popular package which is ready for
+        download and mark it active, or "NULL" if there is no such package
+        or max_conn connections are active already.
+        """
+        if len(self.active) >= max_conn:
+            return "NULL"
+        # Packages are queued before their details are set, skip those.
+        skipped = []
+        params = "NULL"
+        while len(self.scores) > 0:
+            score = self.scores.get(self.scores.peek())
+            package = self.scores.pop()
+            if package in self.active:
+                continue
+            if self.queue.get(package):
+                params = self.queue[package]
+                # Active packages don't need a score. Clients requesting
+                # them are sent upstream until they are cached.
+                self.add_conn(package)
+                break
+            skipped.append((package, score))
+        for (package, score) in skipped:
+            self.scores.set(package, score)
+        return params
+
+    def wait_for_work(self, timeout):
+        """Wait until a package is queued for download or a connection is
+        freed, or until timeout seconds have passed."""
+        self.work.acquire()
+        if not self.pending:
+            self.work.wait(timeout)
+        self.pending = False
+        self.work.release()
+        return True
+
+    # Functions related to cache size accounting.
+    # Sizes are kept in kilo bytes.
+    def set_cache_size(self, type, size):
+        """Set the size of the cache directory for packages of 'type'."""
+        self.cache_sizes[type] = size
+        return True
+
+    def update_cache_size(self, type, incr):
+        """Add incr (which may be negative) to the size of the cache directory for 'type'."""
+        self.cache_sizes[type] = self.cache_sizes.get(type, 0) + incr
+        return True
+
+    def get_cache_size(self, type):
+        """Return the size of the cache directory for 'type' in mega bytes."""
+        return self.cache_sizes.get(type, 0) / 1024
+
+    # Functions related to the catalogue of cached packages.
+    def hit(self, type, package):
+        """Return whether package of 'type' is cached. A cached package is
+        dequeued and its hit is recorded."""
+        if not self.catalogue.hit(type, package):
+            if not self.adopt_flat(type, package) or not self.catalogue.hit(type, package):
+                return False
+        self.remove(package)
+        self.remove_conn(package)
+        self.metrics.inc('cache_hits_total', type)
+        self.metrics.inc('bytes_served_total', type, self.catalogue.get(type)[package][SIZE])
+        return True
+
+    def adopt_flat(self, type, package):
+        """
+        Versions before mirror_rules cached every package under its name at
+        the top of the cache directory. Move such a package to the place of
+        package, e.g. on its first request after an upgrade, and catalogue it
+        as package. Returns whether it was moved.
+        """
+        name = os.path.basename(package)
+        entry = self.catalogue.get(type).get(name)
+        cache_dir = dict(cache_dirs()).get(type)
+        if name == package or entry is None or cache_dir is None:
+            return False
+        try:
+            make_dirs(os.path.dirname(os.path.join(cache_dir, package)))
+            os.rename(os.path.join(cache_dir, name), os.path.join(cache_dir, package))
+        except OSError:
+            return False
+        self.catalogue.remove(type, name)
+        self.catalogue.add(type, package, entry[SIZE], entry[DIGEST])
+        return True
+
+    def add_cached(self, type, package, size, digest):
+        """Add package of 'type' of size bytes to the catalogue."""
+        self.catalogue.add(type, package, size, digest)
+        return True
+
+    def remove_cached(self, type, package):
+        """Remove an evicted package of 'type' from the catalogue."""
+        self.catalogue.remove(type, package)
+        return True
+
+    def get_cached(self, type):
+        """Return a dictionary of package -> [size, digest, insert time,
+        last hit time, hits] for the cached packages of 'type'."""
+        return self.catalogue.get(type)
+
+    def watch_cached(self, type):
+        """Call before scanning the cache directory for 'type' to pass the
+        result to reconcile_cached()."""
+        self.catalogue.watch(type)
+        return True
+
+    def reconcile_cached(self, type, packages):
+        """Make the catalogue for 'type' agree with packages, a dictionary of
+        package -> size of the files found in the cache directory. Packages
+        added, hit or removed since watch_cached() are left alone, as the
+        scan may have missed the change. Returns the number of packages
+        added and removed."""
+        cached = self.catalogue.get(type)
+        changed = self.catalogue.unwatch(type)
+        added = 0
+        removed = 0
+        for package in cached.keys():
+            if package not in packages and package not in changed:
+                self.catalogue.remove(type, package)
+                removed += 1
+        for (package, size) in packages.items():
+            if package in changed:
+                continue
+            if package not in cached or cached[package][SIZE] != size:
+                self.catalogue.add(type, package, size, '')
+                added += 1
+        return (added, removed)
+    # Functions related to the stream server.
+    def set_streaming(self, up):
+        """Record whether stream_server() is up."""
+        self.streaming = up
         return True
 
+    def is_streaming(self):
+        """Return whether stream_server() is up."""
+        return self.streaming
+
+    # Functions related to metrics.
+    def merge_metrics(self, counters, histograms):
+        """Add the metrics collected by an instance of intelligentmirror."""
+        self.metrics.merge(counters, histograms)
+        return True
+
+    def get_metrics(self):
+        """Return (counters, histograms, gauges) where every item maps
+        (name, type) to a value."""
+        gauges = {}
+        gauges[('queued_packages', '')] = len(self.scores)
+        gauges[('active_downloads', '')] = len(self.active)
+        for (type, size) in self.cache_sizes.items():
+            gauges[('cache_size_bytes', type)] = size * 1024
+        for type in self.catalogue.entries.keys():
+            gauges[('cached_packages', type)] = len(self.catalogue.get(type))
+        # Copies, as the result is marshalled after the lock is released.
+        histograms = dict([(key, values[:]) for (key, values) in self.metrics.histograms.items()])
+        return (self.metrics.counters.copy(), histograms, gauges)
+
+def flush_metrics(force = False):
+    """Merge the metrics collected by this process into PackagePool, at most
+    every metrics_flush_interval seconds unless force is set."""
+    global metrics_flushed
+    if not force and time.time() - metrics_flushed < metrics_flush_interval:
+        return
+    metrics_flushed = time.time()
+    (counters, histograms) = metrics.drain()
+    if counters or histograms:
+        try:
+            package_pool.merge_metrics(counters, histograms)
+        except:
+            pass
+    return
 
 def remove(package):
     """Remove package from queue."""
-    package_pool.remove(package)
-    package_pool.remove_conn(package)
+    calls = package_pool.pipeline()
+    calls.remove(package)
+    calls.remove_conn(package)
+    calls.execute()
     return
 
 def queue(package, values):
@@ -216,32 +643,135 @@ def queue(package, values):
     package_pool.set(package, values)
     return
 
-def fork(f):
-    """Generator for creating a forked process
-    from a function"""
-    # Perform double fork
-    r = ''
-    if os.fork(): # Parent
-        # Wait for children so that they don't get defunct.
-        os.wait()
-        # Return a function
-        return  lambda *x, **kw: r 
-
-    # Otherwise, we are the child 
-    # Perform second fork
-    os.setsid()
-    os.umask(077)
-    os.chdir('/')
-    if os.fork():
-        os._exit(0) 
-
-    def wrapper(*args, **kwargs):
-        """Wrapper function to be returned from generator.
-        Executes the function bound to the generator and then
-        exits the process"""
-        f(*args, **kwargs)
-        os._exit(0)
-    return wrapper
+def admit(client, package, type, size, max_size, min_size):
+    """Check size (in kilo bytes) of package against max_size and min_size.
+    A package which doesn't fit is removed from queue."""
+    if max_size and size > max_size:
+        remove(package)
+        log(client, package, 'MAX_SIZE', type, 'Package size ' + str(size) + ' is larger than maximum allowed.')
+        return False
+    if min_size and size < min_size:
+        remove(package)
+        log(client, package, 'MIN_SIZE', type, 'Package size ' + str(size) + ' is smaller than minimum allowed.')
+        return False
+    return True
+
+def transfer(remote_file, file, size, max_size, digest):
+    """Copy remote_file to file which already holds size bytes and return the
+    new size. The data is added to digest on the way. The transfer stops as
+    soon as max_size kilo bytes are exceeded."""
+    while True:
+        data = remote_file.read(download_block_size)
+        if not data:
+            break
+        file.write(data)
+        digest.update(data)
+        size += len(data)
+        if max_size and size / 1024 > max_size:
+            break
+    return size
+
+def read_validator(download_path):
+    """Return the validator (ETag or Last-Modified) of a partial download."""
+    try:
+        file = open(download_path + '.validator')
+        try:
+            return file.read().strip()
+        finally:
+            file.close()
+    except IOError:
+        return None
+
+def write_validator(download_path, validator):
+    """Remember the validator of a partial download. Without a validator,
+    the download can't be resumed."""
+    if validator is None:
+        discard_validator(download_path)
+        return
+    file = open(download_path + '.validator', 'w')
+    try:
+        file.write(validator)
+    finally:
+        file.close()
+
+def discard_validator(download_path):
+    if os.path.exists(download_path + '.validator'):
+        os.unlink(download_path + '.validator')
+
+def discard_partial(download_path):
+    """Remove a partial download so that it is restarted from scratch."""
+    discard_validator(download_path)
+    if os.path.exists(download_path):
+        os.unlink(download_path)
+
+def fetch(client, url, download_path, package, type, max_size, min_size):
+    """Download url to download_path, resuming from the partial file left by
+    an earlier attempt if there is one. Returns the size of the package in
+    bytes, or -1 if it doesn't fit the size limits, and the hex digest of
+    the package."""
+    offset = 0
+    headers = ()
+    validator = read_validator(download_path)
+    if validator is not None and os.path.exists(download_path):
+        offset = os.stat(download_path)[6]
+        # If-Range makes the server send the whole package if it has changed.
+        headers = (('Range', 'bytes=%d-' % offset), ('If-Range', validator))
+
+    # The size limits are checked against the headers and then against
+    # the data of the same request, so the package is requested only once.
+    remote_file = grabber.urlopen(url, http_headers = headers)
+    try:
+        info = remote_file.info()
+        content_range = info.getheader('content-range')
+        if offset and content_range and content_range.startswith('bytes %d-' % offset):
+            mode = 'ab'
+            total = content_range.split('/')[-1]
+            log(client, package, 'RESUME', type, 'Resuming download at byte ' + str(offset) + '.', bytes = offset)
+        else:
+            offset = 0
+            mode = 'wb'
+            total = info.getheader('content-length')
+        if total is not None and total.isdigit() and not admit(client, package, type, int(total) / 1024, max_size, min_size):
+            return (-1, None)
+
+        # Weak ETags can't be used with If-Range.
+        validator = info.getheader('etag')
+        if validator is None or validator.startswith('W/'):
+            validator = info.getheader('last-modified')
+        write_validator(download_path, validator)
+
+        digest = new_digest()
+        if mode == 'ab':
+            hash_file(download_path, digest)
+        file = open(download_path, mode)
+        # Clients can be streamed the package from now on.
+        if total is not None and total.isdigit():
+            package_pool.set_conn_size(package, int(total))
+        else:
+            package_pool.set_conn_size(package, -1)
+        try:
+            size = transfer(remote_file, file, offset, max_size, digest)
+        finally:
+            file.close()
+        metrics.inc('bytes_fetched_total', type, size - offset)
+    finally:
+        remote_file.close()
+
+    if not admit(client, package, type, size / 1024, max_size, min_size):
+        return (-1, None)
+    if total is not None and total.isdigit() and size != int(total):
+        # The mirror closed the connection before the end of the package.
+        # The partial file and its validator are kept to resume from.
+        raise IOError('Download ended at byte %d of %s.' % (size, total))
+    return (size, digest.hexdigest())
+
+def reset_locks():
+    """Re-create the locks of the log and the metrics in a download worker.
+    A worker replacing one which died is forked by download_scheduler(), and
+    the locks held by the other threads of the leader at that time are never
+    released in the worker."""
+    log.after_fork()
+    metrics.after_fork()
 
 def download_from_source(args):
     """This function downloads the file from remote source and caches it."""
@@ -253,41 +783,63 @@ def download_from_source(args):
     type = args[5]
     max_size = args[6]
     min_size = args[7]
-    if max_size or min_size:
+    download_path = partial_path(package)
+    started = time.time()
+    retries = 0
+    while True:
         try:
-            log(format%(client, package, 'GET_SIZE', type, 'Trying to get the size of the package.'))
-            remote_file = grabber.urlopen(url)
-            remote_size = int(remote_file.info().getheader('content-length')) / 1024
-            remote_file.close()
-            log(format%(client, package, 'GOT_SIZE', type, 'Successfully retrieved the size of the package.'))
-        except urlgrabber.grabber.URLGrabError, e:
-            remove(package)
-            log(format%(client, package, 'SIZE_ERR', type, 'Could not retrieve size of the package.'))
-            return
+            (size, digest) = fetch(client, url, download_path, package, type, max_size, min_size)
+            break
+        except IOError, e:
+            # URLGrabError is an IOError.
+            try:
+                code = int(getattr(e, 'code', 0))
+            except (TypeError, ValueError):
+                code = 0
+            if code == 416:
+                # The partial file is not a prefix of the package anymore.
+                discard_partial(download_path)
+            elif retries >= download_retries or 400 <= code < 500:
+                remove(package)
+                log(client, package, 'DOWNLOAD_ERR', type, 'An error occured while retrieving the package.', latency = time.time() - started)
+                metrics.inc('download_errors_total', type)
+                flush_metrics(True)
+                if code:
+                    discard_partial(download_path)
+                return
+            # Wait longer after every failure so a struggling mirror isn't hammered.
+            delay = download_retry_delay * 2 ** retries
+            retries += 1
+            log(client, package, 'RETRY', type, 'Retrying download in ' + str(delay) + ' seconds.')
+            time.sleep(delay)
 
-        if max_size and remote_size > max_size:
-            remove(package)
-            log(format%(client, package, 'MAX_SIZE', type, 'Package size ' + str(remote_size) + ' is larger than maximum allowed.'))
-            return
-        if min_size and remote_size < min_size:
-            remove(package)
-            log(format%(client, package, 'MIN_SIZE', type, 'Package size ' + str(remote_size) + ' is smaller than minimum allowed.'))
-            return
+    if size < 0:
+        discard_partial(download_path)
+        return
 
+    # A package being replaced no longer counts towards the cache size.
     try:
-        download_path = os.path.join(temp_dir, os.path.basename(path))
-        open(download_path, 'a').close()
-        file = grabber.urlgrab(url, download_path)
-        os.rename(file, path)
-        os.chmod(path, mode)
-        remove(package)
-        size = os.stat(path)[6]
-        log(format%(client, package, 'DOWNLOAD', type, str(size) + ' Package was downloaded and cached.'))
-    except urlgrabber.grabber.URLGrabError, e:
-        remove(package)
-        log(format%(client, package, 'DOWNLOAD_ERR', type, 'An error occured while retrieving the package.'))
-        os.unlink(download_path)
-
+        old_size = os.stat(path)[6]
+    except OSError:
+        old_size = 0
+    discard_validator(download_path)
+    make_dirs(os.path.dirname(path))
+    added = size
+    if not store.add(download_path, digest, path):
+        # The package shares the blob of an identical package cached already.
+        added = 0
+        log(client, package, 'DEDUP', type, digest + ' Package was cached already under another name.')
+    os.chmod(path, mode)
+    calls = package_pool.pipeline()
+    calls.add_cached(type, package, size, digest)
+    calls.remove(package)
+    calls.remove_conn(package)
+    calls.update_cache_size(type, added / 1024 - old_size / 1024)
+    calls.execute()
+    log(client, package, 'DOWNLOAD', type, str(size) + ' Package was downloaded and cached.', bytes = size, latency = time.time() - started)
+    metrics.inc('downloads_total', type)
+    metrics.observe('download_duration_seconds', time.time() - started, type)
+    flush_metrics(True)
     return
 
 def cache_package(client, url, type, package):
@@ -315,123 +867,601 @@ def cache_package(client, url, type, package):
         cache_size = deb_cache_size
         cache_dir = deb_cache_dir
 
-    if os.path.isfile(path):
-        log(format%(client, package, 'CACHE_HIT', type, 'Requested package was found in cache.'))
-        remove(package)
-        log(format%(client, package, 'CACHE_SERVE', type, 'Package was served from cache.'))
+    # The catalogue answers without touching the cache directory.
+    if package_pool.hit(type, package):
+        log(client, package, 'CACHE_HIT', type, 'Requested package was found in cache.')
+        log(client, package, 'CACHE_SERVE', type, 'Package was served from cache.')
         return redirect + ':' + os.path.join(cached_url, package)
-    elif cache_size == 0 or dir_size(cache_dir) < cache_size:
-        log(format%(client, package, 'CACHE_MISS', type, 'Requested package was not found in cache.'))
+    elif cache_size == 0 or package_pool.get_cache_size(type) < cache_size:
+        log(client, package, 'CACHE_MISS', type, 'Requested package was not found in cache.')
+        metrics.inc('cache_misses_total', type)
         queue(package, [client, url, path, mode, package, type, max_size, min_size])
+        if streaming():
+            log(client, package, 'STREAM', type, 'Package will be streamed while it is downloaded.')
+            return redirect + ':' + stream_url(type, package, url)
     else:
-        log(format%(client, package, 'CACHE_FULL', type, 'Cache directory \'' + cache_dir + '\' has exceeded the maximum size allowed.'))
+        # Don't leave the package in queue without details. It will be
+        # cached on a later request once cache_evictor() has made room.
+        remove(package)
+        metrics.inc('cache_full_total', type)
+        log(client, package, 'CACHE_FULL', type, 'Cache directory \'' + cache_dir + '\' has exceeded the maximum size allowed.')
+
+    return url
+
+def streaming():
+    """Return whether clients can be sent to stream_server(). It is asked
+    from PackagePool at most every stream_check_interval seconds."""
+    global stream_checked, stream_up
+    if not stream_port:
+        return False
+    if time.time() - stream_checked >= stream_check_interval:
+        stream_checked = time.time()
+        try:
+            stream_up = package_pool.is_streaming()
+        except:
+            stream_up = False
+    return stream_up
+
+def stream_url(type, package, url):
+    """Return the url at which package is streamed while it is downloaded."""
+    import urllib
+    return 'http://%s:%d/%s/%s?%s' % (cache_host, stream_port, type.lower(), urllib.quote(package), urllib.quote(url, ''))
 
+def stream_package(client, url, type, package):
+    """Send the client of a package which is queued or being downloaded
+    already to stream_server(), if it is enabled. The stream server waits
+    up to stream_wait seconds for a queued download to start."""
+    if not streaming():
+        return url
+    calls = package_pool.pipeline()
+    calls.get_details(package)
+    calls.is_active(package)
+    (details, active) = calls.execute()
+    if details or active:
+        log(client, package, 'STREAM', type, 'Package is being streamed from the queued or active download.')
+        return redirect + ':' + stream_url(type, package, url)
     return url
 
+def rewrite(url):
+    """Process a request from squid. url is the list of fields in the request
+    line, i.e. url, client ip/fqdn, ident and method. Returns the url which
+    squid should fetch instead."""
+    new_url = url[0]
+    # Retrieve the basename from the request url
+    fragments = urlparse.urlsplit(url[0])
+    host = fragments[1]
+    path = fragments[2]
+    params = fragments[3]
+    client = url[1].split('/')[0]
+    started = time.time()
+    log(client, '-', 'REQUEST', '-', url[0])
+
+    # The stream server sends clients upstream when a package can't be
+    # streamed. Don't queue the package and send them back again.
+    upstream = unmark_upstream(url[0])
+    if upstream is not None:
+        log(client, '-', 'UPSTREAM', '-', upstream)
+        return upstream
+
+    # rpm caching is handled here.
+    try:
+        if enable_rpm_cache and host.find(cache_host) < 0:
+            for file in rpm_files:
+                if path.endswith(file):
+                    # This signifies that URL is a rpm package
+                    # Packages are identified by their canonical key, so the
+                    # same package is a hit whichever mirror it comes from.
+                    package = canonicalizer.key(host, path)
+                    type = 'RPM'
+                    if package is None:
+                        break
+                    metrics.inc('requests_total', type)
+                    if not package_pool.add_or_inc_score(package):
+                        log(client, package, 'URL_HIT', type, url[0])
+                        new_url = cache_package(client, url[0], type, package)
+                        log(client, package, 'NEW_URL', type, new_url, latency = time.time() - started)
+                    else:
+                        new_url = stream_package(client, url[0], type, package)
+    except:
+        log(client, '-', 'NEW_URL', 'RPM', 'Error in parsing the url ' + new_url)
+
+    # deb caching is handled here.
+    try:
+        if enable_deb_cache and host.find(cache_host) < 0:
+            for file in deb_files:
+                if path.endswith(file):
+                    # This signifies that URL is a deb package
+                    package = canonicalizer.key(host, path)
+                    type = 'DEB'
+                    if package is None:
+                        break
+                    metrics.inc('requests_total', type)
+                    if not package_pool.add_or_inc_score(package):
+                        log(client, package, 'URL_HIT', type, url[0])
+                        new_url = cache_package(client, url[0], type, package)
+                        log(client, package, 'NEW_URL', type, new_url, latency = time.time() - started)
+                    else:
+                        new_url = stream_package(client, url[0], type, package)
+    except:
+        log(client, '-', 'NEW_URL', 'DEB', 'Error in parsing the url ' + new_url)
+
+    metrics.observe('rewrite_latency_seconds', time.time() - started)
+    return new_url
+
+def reply(line):
+    """Write a line to stdout for squid to process."""
+    stdout_lock.acquire()
+    try:
+        try:
+            sys.stdout.write(line + '\n')
+            sys.stdout.flush()
+        except IOError, e:
+            if e.errno == 32:
+                os.kill(os.getpid(), 1)
+                # Squid has gone away. The leader handles SIGHUP in its main
+                # thread, don't keep reading from squid meanwhile.
+                raise SystemExit
+    finally:
+        stdout_lock.release()
+
 def squid_part():
     """This function will tap requests from squid. If the request is for a rpm/deb
     package, they will be forwarded to function cache_package() for further processing.
     Finally this function will flush a cache_url if package found in cache or a
     blank line in case on a miss to stdout. This is the only function where we deal
     with squid, rest of the program/project doesn't interact with squid at all."""
+    if url_rewrite_concurrency:
+        return squid_part_concurrent()
     while True:
+        # Read url from stdin ( this is provided by squid)
+        url = sys.stdin.readline().strip().split(' ')
         try:
-            # Read url from stdin ( this is provided by squid)
-            url = sys.stdin.readline().strip().split(' ')
-            new_url = url[0];
-            # Retrieve the basename from the request url
-            fragments = urlparse.urlsplit(url[0])
-            host = fragments[1]
-            path = fragments[2]
-            params = fragments[3]
-            client = url[1].split('/')[0]
-            log(format%(client, '-', 'REQUEST', '-', url[0]))
+            new_url = rewrite(url)
         except IndexError, e:
-            log(format%('-', '-', 'RELOAD', '-', 'IntelligentMirror plugin was reloaded.'))
+            log('-', '-', 'RELOAD', '-', 'IntelligentMirror plugin was reloaded.')
+            new_url = url[0]
+        # Flush the new url to stdout for squid to process
+        reply(new_url)
+        flush_metrics()
+        # Squid sends the next request once this one is answered, so none is
+        # left in the buffer of stdin.
+        if leader_lock is None and not package_pool.reachable():
+            take_over()
 
-        # rpm caching is handled here.
+def rewrite_worker(requests):
+    """Answer the requests queued by squid_part_concurrent()."""
+    while True:
+        (channel, url) = requests.get()
         try:
-            if enable_rpm_cache and host.find(cache_host) < 0:
-                for file in rpm_files:
-                    if path.endswith(file):
-                        # This signifies that URL is a rpm package
-                        package = os.path.basename(path)
-                        type = 'RPM'
-                        packages = package_pool.get()
-                        if package in packages:
-                            package_pool.inc_score(package)
-                            pass
-                        else:
-                            package_pool.add(package)
-                            log(format%(client, package, 'URL_HIT', type, url[0]))
-                            new_url = cache_package(client, url[0], type, package)
-                            log(format%(client, package, 'NEW_URL', type, new_url))
-        except:
-            log(format%(client, '-', 'NEW_URL', 'RPM', 'Error in parsing the url ' + new_url))
+            try:
+                new_url = rewrite(url)
+            except:
+                # Squid waits for an answer on every channel.
+                new_url = url[0]
+            reply(channel + ' ' + new_url)
+            flush_metrics()
+        finally:
+            requests.done()
+
+class RequestQueue:
+    """Requests read by squid_part_concurrent() for the rewrite workers. It
+    counts the requests not answered yet as Queue.Queue only does so since
+    python 2.5."""
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.pending = 0
+        self.answered = threading.Condition(threading.Lock())
 
-        # deb caching is handled here.
+    def put(self, request):
+        self.answered.acquire()
+        self.pending += 1
+        self.answered.release()
+        self.queue.put(request)
+
+    def get(self):
+        return self.queue.get()
+
+    def done(self):
+        """Mark a request taken by get() as answered."""
+        self.answered.acquire()
         try:
-            if enable_deb_cache and host.find(cache_host) < 0:
-                for file in deb_files:
-                    if path.endswith(file):
-                        # This signifies that URL is a deb package
-                        package = os.path.basename(path)
-                        type = 'DEB'
-                        packages = package_pool.get()
-                        if package in packages:
-                            package_pool.inc_score(package)
-                            pass
-                        else:
-                            package_pool.add(package)
-                            log(format%(client, package, 'URL_HIT', type, url[0]))
-                            new_url = cache_package(client, url[0], type, package)
-                            log(format%(client, package, 'NEW_URL', type, new_url))
-        except:
-            log(format%(client, '-', 'NEW_URL', 'DEB', 'Error in parsing the url ' + new_url))
+            self.pending -= 1
+            if self.pending == 0:
+                self.answered.notifyAll()
+        finally:
+            self.answered.release()
 
-        # Flush the new url to stdout for squid to process
+    def join(self):
+        """Wait until all the requests are answered."""
+        self.answered.acquire()
         try:
-            sys.stdout.write(new_url + '\n')
-            sys.stdout.flush()
-        except IOError, e:
-            if e.errno == 32:
-                os.kill(os.getpid(), 1)
+            while self.pending:
+                self.answered.wait()
+        finally:
+            self.answered.release()
+
+class LineReader:
+    """Read lines from the descriptor fd. Unlike a file object, it tells
+    whether data following the last line read is buffered."""
+    def __init__(self, fd):
+        self.fd = fd
+        self.buffer = ''
+
+    def readline(self):
+        """Return the next line, or '' at the end of the file."""
+        while '\n' not in self.buffer:
+            data = os.read(self.fd, 4096)
+            if not data:
+                (line, self.buffer) = (self.buffer, '')
+                return line
+            self.buffer += data
+        (line, self.buffer) = self.buffer.split('\n', 1)
+        return line + '\n'
+
+    def buffered(self):
+        return self.buffer != ''
+
+def squid_part_concurrent():
+    """Same as squid_part() but for url_rewrite_concurrency > 0 in squid. Every
+    request line starts with a channel ID and the answer for that request must
+    start with the same ID. Requests are processed by url_rewrite_concurrency
+    threads and answered as soon as they are processed, in any order."""
+    requests = RequestQueue()
+    for i in range(url_rewrite_concurrency):
+        thread = threading.Thread(target = rewrite_worker, args = (requests,))
+        thread.setDaemon(True)
+        thread.start()
+    stdin = LineReader(sys.stdin.fileno())
+    while True:
+        # Requests read but not queued yet would be lost by take_over().
+        if leader_lock is None and not stdin.buffered() and not package_pool.reachable():
+            take_over(requests)
+        url = stdin.readline().strip().split(' ')
+        if len(url) < 2:
+            log('-', '-', 'RELOAD', '-', 'IntelligentMirror plugin was reloaded.')
+            # Keep answering until squid has gone away, like squid_part() does.
+            reply(url[0])
+            continue
+        requests.put((url[0], url[1:]))
 
-def start_xmlrpc_server():
-    """Starts the XMLRPC server in a threaded process."""
+def start_rpc_server():
+    """Starts the RPC server in a threaded process."""
     try:
-        server = SimpleXMLRPCServer((rpc_host, rpc_port), logRequests=0)
-        server.register_instance(PackagePool())
-        log(format%('-', '-', 'XMLRPCSERVER', '-', 'Starting XMLRPCServer on port ' + str(rpc_port) + '.'))
-        # Rotate logfiles if the size is more than the max_logfile_size.
-        if os.stat(logfile)[6] > max_logfile_size:
-            roll = logging.handlers.RotatingFileHandler(filename=logfile, mode='r', maxBytes=max_logfile_size, backupCount=max_logfile_backups)
-            roll.doRollover()
+        pool = PackagePool(Catalogue(catalogue_file))
+        if pool.catalogue.fresh:
+            # Build the catalogue from the cache directories on the first
+            # start. It is loaded from catalogue_file afterwards.
+            for (type, cache_dir) in cache_dirs():
+                packages = scan_packages(cache_dir)
+                if packages is not None:
+                    pool.reconcile_cached(type, packages)
+        # Seed the cache size accounting once. It is kept up to date by
+        # download_from_source() and cache_size_reconciler() afterwards.
+        for (type, cache_dir, cache_size) in sized_cache_dirs():
+            size = dir_size(cache_dir)
+            if size >= 0:
+                pool.set_cache_size(type, size)
+        # Pick up the work left by the previous instance on a reload.
+        (queued, active) = pool.restore(pool_file)
+        if queued or active:
+            log('-', '-', 'RESTORE', '-', '%d queued and %d active packages restored from %s .' % (queued, active, pool_file))
+        pool.catalogue.start(pool.lock, catalogue_flush_interval)
+        server = PoolServer(rpc_socket, pool, pool.lock)
+        rpc_started.set()
+        log('-', '-', 'RPCSERVER', '-', 'Starting RPC server on ' + rpc_socket + '.')
         server.serve_forever()
     except:
         pass
 
 def download_scheduler():
     """Schedule packages from download queue for downloading."""
-    log(format%('-', '-', 'SCHEDULEDER', '-', 'Download Scheduler starting.'))
-    time.sleep(3)
-    package_pool = ServerProxy('http://' + rpc_host + ':' + str(rpc_port))
+    log('-', '-', 'SCHEDULEDER', '-', 'Download Scheduler starting.')
+    # The downloads restored from pool_file are scheduled once the RPC
+    # server has loaded them.
+    rpc_started.wait()
+    package_pool = PoolProxy(rpc_socket)
+    saved = time.time()
+    while True:
+        # Free the slots of the downloads whose worker died or was cancelled.
+        for (pid, package) in workers.reap():
+            remove(package)
+            log('-', package, 'WORKER_DIED', '-', 'Download worker ' + str(pid) + ' exited before finishing the download.')
+        # Free the slots of the downloads which failed with an error
+        # download_from_source() didn't handle, e.g. while storing the package.
+        for (pid, package) in workers.failed():
+            remove(package)
+            log('-', package, 'DOWNLOAD_ERR', '-', 'Download worker ' + str(pid) + ' failed to download or store the package.')
+        # Downloads restored from pool_file run in the workers of the previous
+        # instance, which exit once they are done.
+        for (pid, package) in package_pool.reap_conns([worker.pid for worker in workers.workers]):
+            log('-', package, 'WORKER_GONE', '-', 'Download worker ' + str(pid) + ' of a previous instance has exited. Package queued again.')
+        if time.time() - saved >= pool_save_interval:
+            package_pool.save(pool_file)
+            saved = time.time()
+        # Fill all the free download slots.
+        while True:
+            params = package_pool.next_download(max_parallel_downloads)
+            if params == "NULL":
+                break
+            log(params[0], params[4], 'SCHEDULED', params[5], 'Package scheduled for download.')
+            pid = workers.submit(params)
+            package_pool.set_conn_worker(params[4], pid)
+        # Sleep until a package is queued or a download finishes. The
+        # timeout bounds the time taken to notice dead workers.
+        package_pool.wait_for_work(10)
+    return
+
+def reconcile_catalogue(package_pool):
+    """Make the catalogue agree with the cache directories, e.g. after
+    packages have been added or deleted by hand."""
+    for (type, cache_dir) in cache_dirs():
+        package_pool.watch_cached(type)
+        packages = scan_packages(cache_dir)
+        if packages is None:
+            log('-', '-', 'RECONCILE_ERR', type, 'Could not scan cache directory \'' + cache_dir + '\'.')
+            continue
+        (added, removed) = package_pool.reconcile_cached(type, packages)
+        if added or removed:
+            log('-', '-', 'RECONCILE', type, '%d packages added to and %d removed from the catalogue.' % (added, removed))
+    return
+
+def cache_size_reconciler():
+    """Periodically rescan the cache directories to correct any drift in
+    the cache size accounting and the catalogue kept by PackagePool."""
+    log('-', '-', 'RECONCILER', '-', 'Cache size reconciler starting.')
+    package_pool = PoolProxy(rpc_socket)
+    while True:
+        time.sleep(cache_size_reconcile_interval)
+        collect_blobs()
+        expire_partials(package_pool)
+        reconcile_catalogue(package_pool)
+        for (type, cache_dir, cache_size) in sized_cache_dirs():
+            size = dir_size(cache_dir)
+            if size >= 0:
+                package_pool.set_cache_size(type, size)
+    return
+
+def collect_blobs():
+    """Remove the blobs of the packages which are not cached anymore."""
+    try:
+        freed = store.collect()
+    except OSError, e:
+        log('-', '-', 'COLLECT_ERR', '-', 'Could not scan blob directory \'' + blob_dir + '\'.')
+        return
+    if freed:
+        log('-', '-', 'COLLECT', '-', str(freed) + ' Bytes freed by removing unused blobs.')
+    return
+
+def expire_partials(package_pool):
+    """Remove the partial downloads in temp_dir which were not written to for
+    partial_max_age seconds, unless their package is queued or active, and
+    the validators left without a partial download."""
+    if partial_max_age <= 0:
+        return
+    # urllib is imported when needed as it loads the ssl module.
+    import urllib
+    try:
+        names = os.listdir(temp_dir)
+    except OSError, e:
+        log('-', '-', 'EXPIRE_ERR', '-', 'Could not scan temp directory \'' + temp_dir + '\'.')
+        return
+    expired = 0
+    freed = 0
+    now = time.time()
+    for name in names:
+        path = os.path.join(temp_dir, name)
+        if name.endswith('.validator') and os.path.exists(path[:-len('.validator')]):
+            # Expired along with its partial download.
+            continue
+        try:
+            stats = os.stat(path)
+        except OSError:
+            continue
+        if now - stats.st_mtime < partial_max_age:
+            continue
+        try:
+            if name.endswith('.validator'):
+                os.unlink(path)
+                continue
+            package = urllib.unquote(name)
+            calls = package_pool.pipeline()
+            calls.get_details(package)
+            calls.is_active(package)
+            (details, active) = calls.execute()
+            if details or active:
+                continue
+            discard_partial(path)
+        except OSError:
+            continue
+        expired += 1
+        freed += stats.st_size
+    if expired:
+        log('-', '-', 'EXPIRE', '-', '%d Bytes freed by removing %d stale partial downloads.' % (freed, expired))
+    return
+
+def evict_packages(package_pool, policy, type, cache_dir, cache_size):
+    """Evict packages from cache_dir according to policy until its size
+    falls below the low watermark."""
+    entries = []
+    total = 0
+    # Map of digest -> number of packages sharing its blob.
+    links = {}
+    cached = package_pool.get_cached(type)
+    for (package, entry) in cached.items():
+        # Packages never served use the time they were cached. Packages
+        # sharing a blob take its space once.
+        blob = entry[DIGEST] or None
+        entries.append((package, entry[SIZE], entry[HITS], max(entry[LAST_HIT], entry[INSERTED]), blob))
+        if blob is None or blob not in links:
+            total += entry[SIZE]
+        if blob is not None:
+            links[blob] = links.get(blob, 0) + 1
+    package_pool.set_cache_size(type, total / 1024)
+
+    excess = total - cache_size * 1024 * 1024 * cache_low_watermark / 100
+    for package in policy.select(entries, excess):
+        path = os.path.join(cache_dir, package)
+        size = cached[package][SIZE]
+        try:
+            os.unlink(path)
+        except OSError, e:
+            if os.path.exists(path):
+                log('-', package, 'EVICT_ERR', type, 'Could not evict package from cache.')
+                continue
+        # The space of a shared blob is freed with its last package.
+        freed = size
+        digest = cached[package][DIGEST]
+        if digest:
+            links[digest] -= 1
+            if links[digest] > 0:
+                freed = 0
+        calls = package_pool.pipeline()
+        calls.remove_cached(type, package)
+        calls.update_cache_size(type, -(freed / 1024))
+        calls.execute()
+        log('-', package, 'EVICT', type, str(size) + ' Package was evicted from cache.', bytes = size)
+    return
+
+def locate(type, package):
+    """Return the paths of package in the cache and in temp_dir, or None if
+    packages of 'type' are not cached or package is not a valid key."""
+    if safe_key(package) != package:
+        return None
+    if type == 'RPM' and enable_rpm_cache:
+        return (os.path.join(rpm_cache_dir, package), partial_path(package))
+    if type == 'DEB' and enable_deb_cache:
+        return (os.path.join(deb_cache_dir, package), partial_path(package))
+    return None
+
+def stream_server():
+    """Stream packages to clients while they are being downloaded."""
+    package_pool = PoolProxy(rpc_socket)
+    try:
+        from stream import StreamServer
+        server = StreamServer(('', stream_port), package_pool, locate, stream_wait)
+    except:
+        log('-', '-', 'STREAMSERVER', '-', 'Could not start stream server on port ' + str(stream_port) + '.')
+        return
+    log('-', '-', 'STREAMSERVER', '-', 'Starting stream server on port ' + str(stream_port) + '.')
+    # Clients are sent to the stream server once it is known to be up. The
+    # RPC server may still be starting.
+    while True:
+        try:
+            package_pool.set_streaming(True)
+            break
+        except:
+            time.sleep(1)
+    try:
+        server.serve_forever()
+    except:
+        log('-', '-', 'STREAMSERVER', '-', 'Stream server on port ' + str(stream_port) + ' stopped.')
+    package_pool.set_streaming(False)
+    return
+
+def metrics_server():
+    """Serve the metrics kept by PackagePool over HTTP."""
+    try:
+        from exporter import MetricsServer
+        server = MetricsServer(('', metrics_port), PoolProxy(rpc_socket))
+        log('-', '-', 'METRICSSERVER', '-', 'Starting metrics server on port ' + str(metrics_port) + '.')
+        server.serve_forever()
+    except:
+        log('-', '-', 'METRICSSERVER', '-', 'Could not start metrics server on port ' + str(metrics_port) + '.')
+    return
+
+def cache_evictor():
+    """Keep the size limited cache directories between the low and the high
+    watermarks by evicting packages according to eviction_policy."""
+    log('-', '-', 'EVICTOR', '-', 'Cache evictor starting with ' + eviction_policy + ' policy.')
+    package_pool = PoolProxy(rpc_socket)
+    # Policies are kept across runs as they may have state.
+    policy = {}
+    while True:
+        time.sleep(eviction_interval)
+        evicted = False
+        for (type, cache_dir, cache_size) in sized_cache_dirs():
+            if package_pool.get_cache_size(type) * 100 < cache_size * cache_high_watermark:
+                continue
+            if type not in policy:
+                policy[type] = policies[eviction_policy]()
+            evict_packages(package_pool, policy[type], type, cache_dir, cache_size)
+            evicted = True
+        if evicted:
+            collect_blobs()
+    return
+
+def cached_versions():
+    """Return a dictionary of (type, name, arch) -> newest cached version
+    for the cached packages."""
+    versions = {}
+    for (type, enabled, cache_dir, parse) in [('RPM', enable_rpm_cache, rpm_cache_dir, rpm_file), ('DEB', enable_deb_cache, deb_cache_dir, deb_file)]:
+        if not enabled:
+            continue
+        for package in cached_packages(cache_dir):
+            try:
+                (name, arch, version) = parse(package)
+            except ValueError:
+                continue
+            newest = versions.get((type, name, arch))
+            if newest is None or compare_versions(type, version, newest) > 0:
+                versions[(type, name, arch)] = version
+    return versions
+
+def prefetch_package(package_pool, cached, type, name, arch, version, url):
+    """Queue the package at url if it is newer than the newest cached
+    version of the package. Returns whether the package was queued."""
+    newest = cached.get((type, name, arch))
+    if newest is None or compare_versions(type, version, newest) <= 0:
+        return False
+    fragments = urlparse.urlsplit(url)
+    package = canonicalizer.key(fragments[1], fragments[2])
+    if package is None:
+        log('-', '-', 'PREFETCH_SKIP', type, 'No cache key for ' + url)
+        return False
+    if type == 'RPM':
+        (cache_dir, cache_size, max_size, min_size) = (rpm_cache_dir, rpm_cache_size, max_rpm_size, min_rpm_size)
+    else:
+        (cache_dir, cache_size, max_size, min_size) = (deb_cache_dir, deb_cache_size, max_deb_size, min_deb_size)
+    path = os.path.join(cache_dir, package)
+    if os.path.isfile(path):
+        return False
+    if cache_size and package_pool.get_cache_size(type) >= cache_size:
+        return False
+    return package_pool.prefetch(package, ['-', url, path, 0755, package, type, max_size, min_size])
+
+def prefetch_packages(package_pool, cached, type, packages):
+    """Queue the newest version of every package listed by repo_packages()
+    which is newer than its cached versions. Returns the number of packages
+    queued."""
+    queued = 0
+    for (name, arch, version, url) in newest_packages(type, packages):
+        if prefetch_package(package_pool, cached, type, name, arch, version, url):
+            queued += 1
+    return queued
+
+def prefetcher():
+    """Periodically queue the new versions of cached packages found in the
+    metadata of prefetch_repos. They are queued with the lowest priority
+    and only during prefetch_hours."""
+    log('-', '-', 'PREFETCHER', '-', 'Prefetcher starting.')
+    package_pool = PoolProxy(rpc_socket)
     while True:
-        if package_pool.get_conn_number() < max_parallel_downloads:
-            #log(format%(str(package_pool.get_conn_number()), '-', 'CONN_AVAIL', '-', '-'))
-            package = package_pool.get_popular()
-            if package != "NULL" and package_pool.is_active(package) == False:
-                #log(format%('-', '-', 'INACTIVE', '-', '-'))
-                params = package_pool.get_details(package)
-                if params != False:
-                    package_pool.set_score(package, 0)
-                    package_pool.add_conn(package)
-                    log(format%(params[0], params[4], 'SCHEDULED', params[5], 'Package scheduled for download.'))
-                    forked = fork(download_from_source)
-                    forked(params)
-            if package_pool.is_active(package) == True:
-                package_pool.set_score(package, 0)
-        time.sleep(3)
+        time.sleep(prefetch_interval)
+        if not in_hours(prefetch_hours, time.localtime()[3]):
+            continue
+        cached = cached_versions()
+        for (kind, url) in prefetch_repos:
+            if kind == 'yum':
+                type = 'RPM'
+            else:
+                type = 'DEB'
+            try:
+                packages = repo_packages(grabber, kind, url)
+            except:
+                log('-', '-', 'PREFETCH_ERR', type, 'Could not read the metadata of ' + url)
+                continue
+            queued = prefetch_packages(package_pool, cached, type, packages)
+            log('-', '-', 'PREFETCH', type, str(queued) + ' Packages queued from ' + url)
     return
 
 class Function_Thread(threading.Thread):
@@ -441,39 +1471,159 @@ class Function_Thread(threading.Thread):
         return
 
     def run(self):
-        if self.fid == XMLRPC_SERVER:
-            start_xmlrpc_server()
+        if self.fid == RPC_SERVER:
+            start_rpc_server()
         elif self.fid == DOWNLOAD_SCHEDULER:
             download_scheduler()
+        elif self.fid == CACHE_SIZE_RECONCILER:
+            cache_size_reconciler()
+        elif self.fid == CACHE_EVICTOR:
+            cache_evictor()
+        elif self.fid == STREAM_SERVER:
+            stream_server()
+        elif self.fid == PREFETCHER:
+            prefetcher()
+        elif self.fid == METRICS_SERVER:
+            metrics_server()
         elif self.fid == BASE_PLUGIN:
             squid_part()
         else:
             return
         return
 
+def show_downloads():
+    """Print the packages being downloaded, their workers and for how long
+    they have been downloading."""
+    now = time.time()
+    for (package, details) in PoolProxy(rpc_socket).get_conn_details().items():
+        print '%s %d %ds' % (package, details[0], now - details[1])
+    return
+
+def cancel_download(package):
+    """Cancel the download of package."""
+    if PoolProxy(rpc_socket).cancel(package):
+        print 'Cancelled the download of ' + package + '.'
+    else:
+        print package + ' is not being downloaded.'
+    return
+
+def save_and_exit(signum, frame):
+    """Save the queue and the active downloads for the next instance and exit,
+    on a reload or when squid has gone away."""
+    try:
+        PoolProxy(rpc_socket).save(pool_file)
+    except:
+        pass
+    log.close()
+    os._exit(0)
+
+def close_and_exit(signum, frame):
+    """Write the queued log records and exit, once squid has gone away from
+    an instance which is not the leader."""
+    log.close()
+    os._exit(0)
+
+def elect_leader():
+    """
+    Return the descriptor of the lock file next to rpc_socket if this
+    instance took the lock and became the leader, which runs the RPC server,
+    the download workers and the other services for all the instances, or
+    None if another instance is the leader. The lock is released when the
+    leader exits, however it exits, and the next instance started or
+    take_over() takes it.
+    """
+    # Passed on by take_over().
+    fd = os.environ.pop('INTELLIGENTMIRROR_LEADER_LOCK', None)
+    if fd is not None:
+        return int(fd)
+    fd = os.open(rpc_socket + '.lock', os.O_RDWR | os.O_CREAT, 0600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+        os.close(fd)
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return fd
+
+def take_over(requests = None):
+    """
+    Called by a follower once its calls to the RPC server fail. If the leader
+    has exited, take its lock and run this program again in this process,
+    keeping the lock and the pipes from squid, to start as the leader.
+    Starting the leader's services in this process instead would fork the
+    download workers from a process running threads. The queue of requests
+    of squid_part_concurrent() is answered first.
+    """
+    fd = elect_leader()
+    if fd is None:
+        return
+    if requests is not None:
+        requests.join()
+    log('-', '-', 'TAKEOVER', '-', 'The leader has exited. Restarting as the leader.')
+    log.close()
+    os.environ['INTELLIGENTMIRROR_LEADER_LOCK'] = str(fd)
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
 if __name__ == '__main__':
-    global grabber, log, package_pool
-    grabber = set_proxy()
+    global grabber, log, package_pool, workers
+    # Command line interface to inspect and cancel downloads.
+    if len(sys.argv) == 2 and sys.argv[1] == 'downloads':
+        show_downloads()
+        sys.exit(0)
+    if len(sys.argv) == 3 and sys.argv[1] == 'cancel':
+        cancel_download(sys.argv[2])
+        sys.exit(0)
+
     log = set_logging()
 
-    # If XMLRPCServer is running already, don't start it again
-    try:
-        time.sleep(int(random.random()*100)%10)
-        package_pool = ServerProxy('http://' + rpc_host + ':' + str(rpc_port))
-        list = package_pool.get()
-        # Flush previous values on reload
-        package_pool.flush()
+    # The RPC server and the download workers are started by the leader only.
+    # The others use them through package_pool, whose calls fail and leave
+    # the urls as they are until the leader has started the RPC server. A
+    # follower takes over once the leader has exited, see take_over().
+    package_pool = PoolProxy(rpc_socket)
+    leader_lock = elect_leader()
+    if leader_lock is None:
+        # The queue and the active downloads are left alone on reload, the
+        # leader keeps scheduling them. reply() sends SIGHUP once squid has
+        # closed its pipes.
+        signal.signal(signal.SIGHUP, close_and_exit)
         # For testing with squid, use this function
         squid_part()
-    except:
-        # Start XMLRPC Server, Download Scheduler and Base Plugin in threads.
-        thread_xmlrpc = Function_Thread(XMLRPC_SERVER)
+    else:
+        # Used by the download workers and the prefetcher.
+        grabber = set_proxy()
+        # Fork the download workers before starting any thread. They must not
+        # keep the lock once the leader has exited.
+        workers = WorkerPool(max_parallel_downloads, download_from_source, [leader_lock], reset_locks, log.close)
+        # Start RPC Server, Download Scheduler, Cache Size Reconciler,
+        # Cache Evictor, Base Plugin, Stream Server, Prefetcher and Metrics
+        # Server in threads.
+        thread_rpc = Function_Thread(RPC_SERVER)
         thread_download_scheduler = Function_Thread(DOWNLOAD_SCHEDULER)
+        thread_cache_size_reconciler = Function_Thread(CACHE_SIZE_RECONCILER)
+        thread_cache_evictor = Function_Thread(CACHE_EVICTOR)
         thread_base_plugin = Function_Thread(BASE_PLUGIN)
-        thread_xmlrpc.start()
+        thread_rpc.start()
         thread_download_scheduler.start()
+        thread_cache_size_reconciler.start()
+        thread_cache_evictor.start()
         thread_base_plugin.start()
-        thread_xmlrpc.join()
-        thread_download_scheduler.join()
-        thread_base_plugin.join()
+        if stream_port:
+            thread_stream_server = Function_Thread(STREAM_SERVER)
+            thread_stream_server.start()
+        if prefetch_repos:
+            thread_prefetcher = Function_Thread(PREFETCHER)
+            thread_prefetcher.start()
+        if metrics_port:
+            thread_metrics_server = Function_Thread(METRICS_SERVER)
+            thread_metrics_server.start()
+        # The base plugin sends SIGHUP once squid has closed its pipes, e.g. on
+        # a reconfigure. The handlers only run in the main thread, so it joins
+        # the threads with a timeout.
+        signal.signal(signal.SIGHUP, save_and_exit)
+        signal.signal(signal.SIGTERM, save_and_exit)
+        for thread in [thread_rpc, thread_download_scheduler, thread_cache_size_reconciler, thread_cache_evictor, thread_base_plugin]:
+            while thread.isAlive():
+                thread.join(1)
 
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# (C) Copyright 2008 Kulbir Saini <kulbirsaini@students.iiit.ac.in>
+#
+
+"""
+Counters and histograms describing the work done by intelligentmirror.
+Every process collects its own metrics and merges them into PackagePool
+from time to time. The merged metrics are rendered in the Prometheus text
+format or as JSON, and served over HTTP by exporter.MetricsServer.
+"""
+
+__author__ = """Kulbir Saini <kulbirsaini@students.iiit.ac.in>"""
+__docformat__ = 'plaintext'
+
+from asynclog import json_string, json_value
+import os
+import threading
+
+# Upper bounds of the histogram buckets, in seconds.
+buckets = {
+    'rewrite_latency_seconds' : (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+    'download_duration_seconds' : (0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0),
+}
+
+descriptions = {
+    'requests_total' : 'Package requests received from squid.',
+    'cache_hits_total' : 'Requests served from the cache.',
+    'cache_misses_total' : 'Requests for packages which were not cached.',
+    'cache_full_total' : 'Misses not queued because the cache directory was full.',
+    'bytes_served_total' : 'Bytes of the packages served from the cache.',
+    'downloads_total' : 'Packages downloaded and cached.',
+    'download_errors_total' : 'Downloads which failed.',
+    'bytes_fetched_total' : 'Bytes downloaded from upstream.',
+    'rewrite_latency_seconds' : 'Time taken to answer a request from squid.',
+    'download_duration_seconds' : 'Time taken to download a package.',
+    'queued_packages' : 'Packages waiting for a download slot.',
+    'active_downloads' : 'Packages being downloaded.',
+    'cache_size_bytes' : 'Size of the cache directory.',
+    'cached_packages' : 'Packages in the catalogue.',
+}
+
+class Metrics:
+    """
+    Counters and histograms, each labelled with a package type ('' for
+    none). A forked child starts with empty metrics so that nothing is
+    merged twice.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def after_fork(self):
+        """Call in a child forked while another thread may hold the lock."""
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        # Map of (name, type) -> value.
+        self.counters = {}
+        # Map of (name, type) -> [count per bucket and one for +Inf, sum].
+        self.histograms = {}
+
+    def inc(self, name, type = '', value = 1):
+        self.lock.acquire()
+        try:
+            if self.pid != os.getpid():
+                self.reset()
+            self.counters[(name, type)] = self.counters.get((name, type), 0) + value
+        finally:
+            self.lock.release()
+
+    def observe(self, name, value, type = ''):
+        self.lock.acquire()
+        try:
+            if self.pid != os.getpid():
+                self.reset()
+            bounds = buckets[name]
+            histogram = self.histograms.get((name, type))
+            if histogram is None:
+                histogram = [0] * (len(bounds) + 1) + [0.0]
+                self.histograms[(name, type)] = histogram
+            i = 0
+            while i < len(bounds) and value > bounds[i]:
+                i += 1
+            histogram[i] += 1
+            histogram[-1] += value
+        finally:
+            self.lock.release()
+
+    def drain(self):
+        """Return the metrics collected since the last drain() as
+        (counters, histograms) and start over."""
+        self.lock.acquire()
+        try:
+            if self.pid != os.getpid():
+                self.reset()
+            drained = (self.counters, self.histograms)
+            self.counters = {}
+            self.histograms = {}
+        finally:
+            self.lock.release()
+        return drained
+
+    def merge(self, counters, histograms):
+        """Add metrics returned by drain() to these metrics."""
+        self.lock.acquire()
+        try:
+            for (key, value) in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for (key, values) in histograms.items():
+                histogram = self.histograms.setdefault(key, [0] * len(values))
+                for i in range(len(values)):
+                    histogram[i] += values[i]
+        finally:
+            self.lock.release()
+
+def labels(type, extra = ''):
+    pairs = []
+    if type:
+        pairs.append('type="%s"' % type)
+    if extra:
+        pairs.append(extra)
+    if pairs:
+        return '{' + ','.join(pairs) + '}'
+    return ''
+
+def prometheus(counters, histograms, gauges):
+    """Return the metrics in the Prometheus text format. gauges maps
+    (name, type) -> value like counters."""
+    lines = []
+    for (kind, values) in [('counter', counters), ('gauge', gauges)]:
+        keys = values.keys()
+        keys.sort()
+        last = None
+        for (name, type) in keys:
+            if name != last:
+                lines.append('# HELP intelligentmirror_%s %s' % (name, descriptions.get(name, name)))
+                lines.append('# TYPE intelligentmirror_%s %s' % (name, kind))
+                last = name
+            lines.append('intelligentmirror_%s%s %s' % (name, labels(type), repr(values[(name, type)])))
+    keys = histograms.keys()
+    keys.sort()
+    last = None
+    for (name, type) in keys:
+        if name != last:
+            lines.append('# HELP intelligentmirror_%s %s' % (name, descriptions.get(name, name)))
+            lines.append('# TYPE intelligentmirror_%s histogram' % name)
+            last = name
+        histogram = histograms[(name, type)]
+        count = 0
+        for i in range(len(buckets[name])):
+            count += histogram[i]
+            lines.append('intelligentmirror_%s_bucket%s %d' % (name, labels(type, 'le="%s"' % str(buckets[name][i])), count))
+        count += histogram[-2]
+        lines.append('intelligentmirror_%s_bucket%s %d' % (name, labels(type, 'le="+Inf"'), count))
+        lines.append('intelligentmirror_%s_sum%s %s' % (name, labels(type), repr(histogram[-1])))
+        lines.append('intelligentmirror_%s_count%s %d' % (name, labels(type), count))
+    return '\n'.join(lines) + '\n'
+
+def to_json(counters, histograms, gauges):
+    """Return the metrics as a JSON object of name -> type -> value.
+    Histograms are objects of bucket upper bound -> number of values in
+    that bucket, plus the sum and count of all values."""
+    names = {}
+    for values in (counters, gauges):
+        for ((name, type), value) in values.items():
+            names.setdefault(name, []).append('%s: %s' % (json_string(type or '-'), json_value(value)))
+    for ((name, type), histogram) in histograms.items():
+        fields = ['%s: %d' % (json_string(str(bound)), count) for (bound, count) in zip(buckets[name], histogram[:-2])]
+        fields.append('"+Inf": %d' % histogram[-2])
+        fields.append('"sum": %s' % repr(histogram[-1]))
+        fields.append('"count": %d' % sum(histogram[:-1]))
+        names.setdefault(name, []).append('%s: {%s}' % (json_string(type or '-'), ', '.join(fields)))
+    items = ['%s: {%s}' % (json_string(name), ', '.join(values)) for (name, values) in names.items()]
+    return '{' + ', '.join(items) + '}\n'
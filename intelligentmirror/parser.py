@@ -19,7 +19,6 @@
 
 import re
 import urlparse
-import urlgrabber
 import os.path
 
 import Errors
@@ -56,6 +55,35 @@ def varReplace(raw, vars):
 
     return ''.join(done)
 
+class LocalFile:
+    """
+    A local file opened by openurl(), providing the geturl() of the files
+    opened by urlgrabber.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.file = open(urlparse.urlsplit(url)[2])
+
+    def readline(self):
+        return self.file.readline()
+
+    def close(self):
+        self.file.close()
+
+    def geturl(self):
+        return self.url
+
+def openurl(url):
+    '''Open url for reading. Raises IOError if it can't be opened.
+
+    Local files are opened directly, so that urlgrabber is only imported
+    for remote includes.
+    '''
+    if urlparse.urlsplit(url)[0] == 'file':
+        return LocalFile(url)
+    import urlgrabber.grabber
+    return urlgrabber.grabber.urlopen(url)
+
 class ConfigPreProcessor:
     """
     ConfigParser Include Pre-Processor
@@ -192,8 +220,8 @@ class ConfigPreProcessor:
         if self._urlalreadyincluded(absurl):
             return None
         try:
-            fo = urlgrabber.grabber.urlopen(absurl)
-        except urlgrabber.grabber.URLGrabError, e:
+            fo = openurl(absurl)
+        except IOError, e:
             fo = None
         if fo is not None:
             self.name = absurl
@@ -228,4 +256,12 @@ class ConfigPreProcessor:
         return 0
     
     
+    def included(self):
+        """
+        Returns the absolute urls of the config file and of every file
+        included so far.
+        """
+        return self._alreadyincluded[:]
+    
+    
     def geturl(self): return self.name
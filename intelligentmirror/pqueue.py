@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# (C) Copyright 2008 Kulbir Saini <kulbirsaini@students.iiit.ac.in>
+#
+
+"""
+Indexed binary max-heap used by PackagePool to keep package scores.
+"""
+
+__author__ = """Kulbir Saini <kulbirsaini@students.iiit.ac.in>"""
+__docformat__ = 'plaintext'
+
+class PriorityQueue:
+    """
+    A max-heap of (score, key) pairs with an index from key to heap position,
+    so that the score of any key can be changed or the key removed in
+    O(log n). The key with the highest score is available in O(1). Keys with
+    the same score are ordered by the key itself.
+    """
+    def __init__(self):
+        self.heap = []
+        self.index = {}
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        """Return all the keys in no particular order."""
+        return self.index.keys()
+
+    def get(self, key, default = None):
+        """Return the score of key."""
+        if key in self.index:
+            return self.heap[self.index[key]][0]
+        return default
+
+    def set(self, key, score):
+        """Add key with score, or change the score of key if present."""
+        if key in self.index:
+            pos = self.index[key]
+            old = self.heap[pos][0]
+            self.heap[pos] = (score, key)
+            if score > old:
+                self._sift_up(pos)
+            else:
+                self._sift_down(pos)
+        else:
+            self.heap.append((score, key))
+            self.index[key] = len(self.heap) - 1
+            self._sift_up(len(self.heap) - 1)
+
+    def inc(self, key, incr = 1):
+        """Increase the score of key by incr."""
+        self.set(key, self.heap[self.index[key]][0] + incr)
+
+    def remove(self, key):
+        """Remove key."""
+        pos = self.index.pop(key)
+        last = self.heap.pop()
+        if pos < len(self.heap):
+            self.heap[pos] = last
+            self.index[last[1]] = pos
+            self._sift_up(pos)
+            self._sift_down(self.index[last[1]])
+
+    def peek(self):
+        """Return the key with the highest score, or None if empty."""
+        if self.heap:
+            return self.heap[0][1]
+        return None
+
+    def pop(self):
+        """Remove and return the key with the highest score, or None if empty."""
+        key = self.peek()
+        if key is not None:
+            self.remove(key)
+        return key
+
+    def _sift_up(self, pos):
+        heap = self.heap
+        item = heap[pos]
+        while pos > 0:
+            parent = (pos - 1) >> 1
+            if heap[parent] >= item:
+                break
+            heap[pos] = heap[parent]
+            self.index[heap[pos][1]] = pos
+            pos = parent
+        heap[pos] = item
+        self.index[item[1]] = pos
+
+    def _sift_down(self, pos):
+        heap = self.heap
+        size = len(heap)
+        item = heap[pos]
+        while True:
+            child = 2 * pos + 1
+            if child >= size:
+                break
+            if child + 1 < size and heap[child + 1] > heap[child]:
+                child += 1
+            if heap[child] <= item:
+                break
+            heap[pos] = heap[child]
+            self.index[heap[pos][1]] = pos
+            pos = child
+        heap[pos] = item
+        self.index[item[1]] = pos
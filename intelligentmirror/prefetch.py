@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# (C) Copyright 2008 Kulbir Saini <kulbirsaini@students.iiit.ac.in>
+#
+
+"""
+Readers for yum and apt repository metadata, used to prefetch the new
+versions of cached packages. A repository is described as yum:<baseurl>
+for yum repositories or apt:<url of Packages.gz> for apt repositories.
+The decompressors and the XML parser are imported when they are first
+used, as the instances answering squid only parse the configuration.
+
+Versions are kept as (epoch, version, release) and compared like rpm and
+dpkg do. The epoch is None when it is not known, e.g. for a version read
+from a file name, and is then not compared.
+"""
+
+__author__ = """Kulbir Saini <kulbirsaini@students.iiit.ac.in>"""
+__docformat__ = 'plaintext'
+
+import os
+import re
+import StringIO
+import urlparse
+
+def parse_repos(text):
+    """Parse whitespace separated kind:url pairs into a list of (kind, url).
+    Raises ValueError for a malformed repository."""
+    repos = []
+    for repo in text.split():
+        (kind, url) = repo.split(':', 1)
+        if kind not in ('yum', 'apt') or not url:
+            raise ValueError('invalid repository "%s"' % repo)
+        repos.append((kind, url))
+    return repos
+
+def parse_hours(text):
+    """Parse an interval of hours like 1-6 into (1, 6)."""
+    (start, end) = text.split('-')
+    return (int(start) % 24, int(end) % 24)
+
+def in_hours(hours, hour):
+    """Return whether hour falls in the interval hours, which may wrap
+    around midnight."""
+    (start, end) = hours
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+def rpm_file(filename):
+    """Return (name, arch, version) of an rpm from its file name
+    name-version-release.arch.rpm."""
+    base = os.path.basename(filename)[:-len('.rpm')]
+    (nvr, arch) = base.rsplit('.', 1)
+    (name, version, release) = nvr.rsplit('-', 2)
+    return (name, arch, (None, version, release))
+
+def deb_file(filename):
+    """Return (name, arch, version) of a deb from its file name
+    name_version_arch.deb."""
+    # urllib is imported when needed as it loads the ssl module.
+    import urllib
+    parts = os.path.basename(filename)[:-len('.deb')].split('_')
+    if len(parts) < 3:
+        raise ValueError(filename)
+    return (parts[0], parts[-1], deb_version(urllib.unquote(parts[1]), None))
+
+def deb_version(text, epoch = '0'):
+    """Return (epoch, upstream version, revision) of the Debian version
+    text. epoch is used if text has none."""
+    if ':' in text:
+        (epoch, text) = text.split(':', 1)
+    revision = ''
+    if '-' in text:
+        (text, revision) = text.rsplit('-', 1)
+    return (epoch, text, revision)
+
+def rpm_compare(a, b):
+    """Compare the version or release strings a and b like rpmvercmp()."""
+    x = re.findall('~|[0-9]+|[a-zA-Z]+', a)
+    y = re.findall('~|[0-9]+|[a-zA-Z]+', b)
+    for i in range(max(len(x), len(y))):
+        s = None
+        t = None
+        if i < len(x):
+            s = x[i]
+        if i < len(y):
+            t = y[i]
+        if s == t:
+            continue
+        # A tilde sorts before anything, even the end of the string.
+        if s == '~':
+            return -1
+        if t == '~':
+            return 1
+        if s is None:
+            return -1
+        if t is None:
+            return 1
+        # A numeric segment is newer than an alphabetic one.
+        if s.isdigit() != t.isdigit():
+            if s.isdigit():
+                return 1
+            return -1
+        if s.isdigit():
+            result = cmp(int(s), int(t))
+        else:
+            result = cmp(s, t)
+        if result:
+            return result
+    return 0
+
+def deb_order(char):
+    if char == '~':
+        return -1
+    if char.isalpha():
+        return ord(char)
+    return ord(char) + 256
+
+def deb_compare(a, b):
+    """Compare the upstream versions or revisions a and b like dpkg."""
+    while a or b:
+        (x, a) = re.match('([^0-9]*)(.*)', a).groups()
+        (y, b) = re.match('([^0-9]*)(.*)', b).groups()
+        for i in range(max(len(x), len(y))):
+            # The end of a string sorts after a tilde and before anything else.
+            s = 0
+            t = 0
+            if i < len(x):
+                s = deb_order(x[i])
+            if i < len(y):
+                t = deb_order(y[i])
+            if s != t:
+                return cmp(s, t)
+        (x, a) = re.match('([0-9]*)(.*)', a).groups()
+        (y, b) = re.match('([0-9]*)(.*)', b).groups()
+        result = cmp(int(x or 0), int(y or 0))
+        if result:
+            return result
+    return 0
+
+def compare_versions(type, a, b):
+    """Compare the versions a and b of packages of 'type', RPM or DEB.
+    Returns a negative number, zero or a positive number if a is older,
+    the same or newer than b."""
+    if a[0] is not None and b[0] is not None:
+        result = cmp(int(a[0] or 0), int(b[0] or 0))
+        if result:
+            return result
+    compare = rpm_compare
+    if type == 'DEB':
+        compare = deb_compare
+    for i in (1, 2):
+        result = compare(a[i] or '', b[i] or '')
+        if result:
+            return result
+    return 0
+
+def newest_packages(type, packages):
+    """Return the newest version in packages, a list of (name, arch, version,
+    url), of every name and arch."""
+    newest = {}
+    for package in packages:
+        current = newest.get(package[:2])
+        if current is None or compare_versions(type, package[2], current[2]) > 0:
+            newest[package[:2]] = package
+    return newest.values()
+
+def decompress(url, data):
+    """Return a file object reading the uncompressed content of data."""
+    if url.endswith('.gz'):
+        import gzip
+        return gzip.GzipFile(fileobj = StringIO.StringIO(data))
+    if url.endswith('.bz2'):
+        import bz2
+        return StringIO.StringIO(bz2.decompress(data))
+    return StringIO.StringIO(data)
+
+class ElementReader:
+    """Call element(name, attrs, text) for every element of an XML document."""
+    def __init__(self, element):
+        self.element = element
+        self.text = []
+        self.attrs = []
+
+    def start(self, name, attrs):
+        self.attrs.append(attrs)
+        self.text = []
+
+    def end(self, name):
+        self.element(name, self.attrs.pop(), ''.join(self.text))
+        self.text = []
+
+    def data(self, text):
+        self.text.append(text)
+
+    def parse(self, file):
+        import xml.parsers.expat
+        parser = xml.parsers.expat.ParserCreate()
+        parser.returns_unicode = False
+        parser.StartElementHandler = self.start
+        parser.EndElementHandler = self.end
+        parser.CharacterDataHandler = self.data
+        parser.ParseFile(file)
+
+def primary_location(file):
+    """Return the location of the primary metadata listed in repomd.xml."""
+    found = {}
+    def element(name, attrs, text):
+        if name == 'location':
+            found['href'] = attrs.get('href')
+        elif name == 'data' and attrs.get('type') == 'primary':
+            found['primary'] = found.get('href')
+    ElementReader(element).parse(file)
+    return found.get('primary')
+
+def yum_packages(file):
+    """Return (name, arch, version, href) for every package in primary.xml."""
+    packages = []
+    current = {}
+    def element(name, attrs, text):
+        if name in ('name', 'arch'):
+            current[name] = text
+        elif name == 'version':
+            current['version'] = (attrs.get('epoch') or '0', attrs.get('ver'), attrs.get('rel'))
+        elif name == 'location':
+            current['href'] = attrs.get('href')
+        elif name == 'package':
+            if 'href' in current and 'version' in current:
+                packages.append((current.get('name'), current.get('arch'), current['version'], current['href']))
+            current.clear()
+    ElementReader(element).parse(file)
+    return packages
+
+def apt_packages(file):
+    """Return (name, arch, version, filename) for every package in a
+    Packages file."""
+    packages = []
+    current = {}
+    while True:
+        line = file.readline()
+        if line.strip() == '':
+            if 'Filename' in current and 'Version' in current:
+                packages.append((current.get('Package'), current.get('Architecture'), deb_version(current['Version']), current['Filename']))
+            current = {}
+            if line == '':
+                break
+            continue
+        if line[0] in ' \t' or ':' not in line:
+            # Continuation of a multi line field.
+            continue
+        (field, value) = line.split(':', 1)
+        current[field] = value.strip()
+    return packages
+
+def repo_packages(grabber, kind, url):
+    """Return (name, arch, version, url) for every package in the repository."""
+    if kind == 'yum':
+        base = url.rstrip('/') + '/'
+        location = primary_location(StringIO.StringIO(grabber.urlread(base + 'repodata/repomd.xml')))
+        if location is None:
+            return []
+        primary = decompress(location, grabber.urlread(base + location))
+        return [(name, arch, version, base + href) for (name, arch, version, href) in yum_packages(primary)]
+    # Filenames in Packages are relative to the root of the archive.
+    root = url[:url.rfind('/dists/') + 1]
+    packages = apt_packages(decompress(url, grabber.urlread(url)))
+    return [(name, arch, version, urlparse.urljoin(root, filename)) for (name, arch, version, filename) in packages]
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# (C) Copyright 2008 Kulbir Saini <kulbirsaini@students.iiit.ac.in>
+#
+
+"""
+RPC transport used to share PackagePool across the instances of
+intelligentmirror. Calls travel over a persistent unix domain socket
+connection. Every call and every result is a marshal encoded frame
+prefixed with its length, and a client may send several calls before
+reading their results (pipelining).
+"""
+
+__author__ = """Kulbir Saini <kulbirsaini@students.iiit.ac.in>"""
+__docformat__ = 'plaintext'
+
+import marshal
+import os
+import socket
+import SocketServer
+import struct
+import threading
+
+# Calls sent at once by a pipeline. The server doesn't read the next call
+# while its socket buffer is full of results, so the results of all the
+# calls in flight must fit in that buffer.
+max_pipelined = 64
+
+class RPCError(Exception):
+    """Raised on the client side when a call failed on the server."""
+    pass
+
+def frame(data):
+    """Return data prefixed with its length."""
+    return struct.pack('!I', len(data)) + data
+
+def read_frame(file):
+    """Read one frame from file. Raises EOFError if the peer has gone away."""
+    header = file.read(4)
+    if len(header) < 4:
+        raise EOFError
+    length = struct.unpack('!I', header)[0]
+    data = file.read(length)
+    if len(data) < length:
+        raise EOFError
+    return data
+
+class PoolRequestHandler(SocketServer.StreamRequestHandler):
+    """Serve calls on a connection until the client closes it."""
+    def handle(self):
+        while True:
+            try:
+                request = read_frame(self.rfile)
+                self.wfile.write(frame(self.server.dispatch(request)))
+            except (EOFError, socket.error):
+                return
+
+class PoolServer(SocketServer.ThreadingUnixStreamServer):
+    """
+    Serve the public methods of instance on the unix domain socket at path.
+    Every connection is served in its own thread, but calls are serialized
+    with lock just like they are with SimpleXMLRPCServer.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, instance, lock = None):
+        if os.path.exists(path):
+            # Left over by a previous server which is not running anymore.
+            os.unlink(path)
+        SocketServer.ThreadingUnixStreamServer.__init__(self, path, PoolRequestHandler)
+        os.chmod(path, 0600)
+        self.instance = instance
+        if lock is None:
+            lock = threading.Lock()
+        self.lock = lock
+
+    def dispatch(self, request):
+        """Call the method described by request and return the marshalled result."""
+        try:
+            (method, args) = marshal.loads(request)
+            if method.startswith('_'):
+                raise AttributeError('method "%s" is not supported' % method)
+            function = getattr(self.instance, method)
+            self.lock.acquire()
+            try:
+                result = function(*args)
+            finally:
+                self.lock.release()
+            return marshal.dumps((True, result))
+        except Exception, e:
+            return marshal.dumps((False, '%s: %s' % (e.__class__.__name__, e)))
+
+class PoolProxy:
+    """
+    Client side of PoolServer. Any method called on a PoolProxy is called on
+    the served instance. Every thread gets its own connection which is
+    opened on its first call and kept open. A forked child opens new
+    connections as well.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._unreachable = False
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._path)
+        except socket.error:
+            sock.close()
+            self._unreachable = True
+            raise
+        self._unreachable = False
+        self._local.sock = sock
+        self._local.rfile = sock.makefile('rb')
+
+    def _close(self):
+        if getattr(self._local, 'sock', None) is not None:
+            self._local.rfile.close()
+            self._local.sock.close()
+        self._local.sock = None
+        self._local.rfile = None
+
+    def _send(self, calls):
+        results = []
+        for i in range(0, len(calls), max_pipelined):
+            batch = calls[i:i + max_pipelined]
+            self._local.sock.sendall(''.join([frame(marshal.dumps(call)) for call in batch]))
+            results += [marshal.loads(read_frame(self._local.rfile)) for call in batch]
+        return results
+
+    def _call(self, calls):
+        """Send all the calls at once and return their results in order."""
+        if self._pid != os.getpid():
+            # The connections belong to our parent.
+            self._reset()
+        try:
+            if getattr(self._local, 'sock', None) is None:
+                self._connect()
+                results = self._send(calls)
+            else:
+                try:
+                    results = self._send(calls)
+                except (EOFError, socket.error):
+                    # The server may have been restarted. Try once more.
+                    self._close()
+                    self._connect()
+                    results = self._send(calls)
+        except:
+            self._close()
+            raise
+
+        values = []
+        for (ok, value) in results:
+            if not ok:
+                raise RPCError(value)
+            values.append(value)
+        return values
+
+    def pipeline(self):
+        """Return a Pipeline to send several calls in one round trip."""
+        return Pipeline(self)
+
+    def reachable(self):
+        """Return False if the last connection to the server failed."""
+        return not self._unreachable
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args: self._call([(name, args)])[0]
+
+class Pipeline:
+    """
+    Collects calls made on it until execute() sends all of them over the
+    proxy and returns the list of their results.
+    """
+    def __init__(self, proxy):
+        self._proxy = proxy
+        self._calls = []
+
+    def execute(self):
+        calls = self._calls
+        self._calls = []
+        if len(calls) == 0:
+            return []
+        return self._proxy._call(calls)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args: self._calls.append((name, args))
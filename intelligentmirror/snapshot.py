@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# (C) Copyright 2008 Kulbir Saini <kulbirsaini@students.iiit.ac.in>
+#
+
+"""
+Snapshot of the parsed configuration, kept next to the configuration file
+with the suffix .snapshot. It holds the option values returned by
+readMainConfig() along with the modification time and size of every file
+they were read from, and is used as long as none of those files changed.
+The helpers squid starts together then read one small file instead of
+each parsing the configuration and its includes.
+"""
+
+__author__ = """Kulbir Saini <kulbirsaini@students.iiit.ac.in>"""
+__docformat__ = 'plaintext'
+
+import fcntl
+import marshal
+import os
+import urlparse
+
+# Changed whenever the layout of a snapshot changes.
+version = 1
+
+class Settings:
+    """The option values of a snapshot, as attributes like YumConf."""
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+def stamp(path):
+    """Return (modification time, size) of the file at path."""
+    st = os.stat(path)
+    return (st.st_mtime, st.st_size)
+
+def sources(urls):
+    """
+    Return [(path, modification time, size)] of the configuration files at
+    urls and of config.py, whose defaults are part of the values, or None if
+    one of the urls is not a local file.
+    """
+    paths = []
+    for url in urls:
+        (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+        if scheme != 'file':
+            return None
+        paths.append(path)
+    code = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.py')
+    if os.path.exists(code):
+        paths.append(code)
+    return [(path,) + stamp(path) for path in paths]
+
+def parse(data):
+    """Return the values stored in the snapshot data, or None if data is not
+    a snapshot or one of its files changed."""
+    try:
+        (snapshot_version, files, values) = marshal.loads(data)
+    except (EOFError, ValueError, TypeError):
+        return None
+    if snapshot_version != version:
+        return None
+    for (path, mtime, size) in files:
+        try:
+            if stamp(path) != (mtime, size):
+                return None
+        except OSError:
+            return None
+    return values
+
+def read_all(fd):
+    os.lseek(fd, 0, 0)
+    size = os.fstat(fd).st_size
+    data = os.read(fd, size)
+    while len(data) < size:
+        chunk = os.read(fd, size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+def write_all(fd, data):
+    os.lseek(fd, 0, 0)
+    os.ftruncate(fd, 0)
+    while data:
+        data = data[os.write(fd, data):]
+
+def parse_config(config_file):
+    """Parse config_file and its includes. Returns (values, sources())."""
+    from config import readMainConfig, readStartupConfig
+    conf = readMainConfig(readStartupConfig(config_file, '/'))
+    values = dict(conf.iteritems())
+    values['config_file_age'] = conf.config_file_age
+    return (values, sources(conf.config_file_urls))
+
+def read_config(config_file):
+    """
+    Return the configuration in config_file as a Settings instance, from the
+    snapshot of config_file if it is up to date. Otherwise config_file is
+    parsed and the snapshot written, by one process at a time so that the
+    others wait and use its snapshot. The configuration is parsed without a
+    snapshot if the snapshot can't be opened.
+    """
+    snapshot_file = config_file + '.snapshot'
+    writable = True
+    try:
+        fd = os.open(snapshot_file, os.O_RDWR | os.O_CREAT, 0644)
+    except OSError:
+        writable = False
+        try:
+            fd = os.open(snapshot_file, os.O_RDONLY)
+        except OSError:
+            return Settings(parse_config(config_file)[0])
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        values = parse(read_all(fd))
+        if values is None and writable:
+            # Another process may have written the snapshot while this one
+            # waited for the lock.
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            values = parse(read_all(fd))
+            if values is None:
+                (values, files) = parse_config(config_file)
+                if files is not None:
+                    try:
+                        write_all(fd, marshal.dumps((version, files, values)))
+                    except (OSError, ValueError):
+                        os.ftruncate(fd, 0)
+        elif values is None:
+            values = parse_config(config_file)[0]
+    finally:
+        os.close(fd)
+    return Settings(values)
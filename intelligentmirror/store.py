@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# (C) Copyright 2008 Kulbir Saini <kulbirsaini@students.iiit.ac.in>
+#
+
+"""
+Content addressed storage for cached packages. Every package is stored
+once as a blob named by the SHA-256 digest of its content. The names in
+the cache directories are hard links to the blobs, so identical packages
+cached under different names share their disk space.
+"""
+
+__author__ = """Kulbir Saini <kulbirsaini@students.iiit.ac.in>"""
+__docformat__ = 'plaintext'
+
+import errno
+import os
+import stat
+
+try:
+    from hashlib import sha256 as new_digest
+except ImportError:
+    # python < 2.5 has no SHA-256.
+    from sha import new as new_digest
+
+# Size of the blocks read while hashing a file.
+block_size = 64 * 1024
+
+def hash_file(path, digest = None):
+    """Update digest with the content of path and return it."""
+    if digest is None:
+        digest = new_digest()
+    file = open(path, 'rb')
+    try:
+        while True:
+            data = file.read(block_size)
+            if not data:
+                break
+            digest.update(data)
+    finally:
+        file.close()
+    return digest
+
+def make_dirs(dir):
+    """Create dir and its parents unless they exist. Several download
+    workers may be creating the same directory at once."""
+    try:
+        os.makedirs(dir)
+    except OSError, e:
+        if e.errno != errno.EEXIST or not os.path.isdir(dir):
+            raise
+
+class BlobStore:
+    """
+    Blobs are kept in blob_dir/<first two hex digits>/<hex digest>. A blob
+    which is not linked from any cache directory anymore is removed by
+    collect().
+    """
+    def __init__(self, blob_dir):
+        self.blob_dir = blob_dir
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def add(self, download_path, digest, path):
+        """
+        Store the file at download_path whose hex digest is 'digest' and
+        link it at path, replacing any file there. Returns False if a blob
+        with the same content was stored already, in which case download_path
+        is removed and path shares the existing blob.
+        """
+        blob = self.blob_path(digest)
+        # Link under a temporary name first so that path is replaced
+        # atomically, even if a client is reading it. The blob is linked
+        # there before anything else, so collect() never finds it with a
+        # single link while it is being added.
+        link = path + '.link'
+        if os.path.exists(link):
+            os.unlink(link)
+        try:
+            os.link(blob, link)
+            new = False
+        except OSError, e:
+            # There is no such blob, or it was just collected.
+            if e.errno != errno.ENOENT:
+                raise
+            new = True
+        if new:
+            os.link(download_path, link)
+            make_dirs(os.path.dirname(blob))
+            os.rename(download_path, blob)
+        else:
+            os.unlink(download_path)
+        if os.path.exists(path) and os.path.samefile(path, link):
+            # rename() does nothing if both names are links to the same file.
+            os.unlink(link)
+        else:
+            os.rename(link, path)
+        return new
+
+    def collect(self):
+        """Remove the blobs which are not linked from any cache directory.
+        Returns the number of bytes freed."""
+        freed = 0
+        if not os.path.isdir(self.blob_dir):
+            return freed
+        for prefix in os.listdir(self.blob_dir):
+            dir = os.path.join(self.blob_dir, prefix)
+            if not os.path.isdir(dir):
+                continue
+            for name in os.listdir(dir):
+                blob = os.path.join(dir, name)
+                try:
+                    stats = os.stat(blob)
+                    if stats[stat.ST_NLINK] == 1:
+                        os.unlink(blob)
+                        freed += stats[stat.ST_SIZE]
+                except OSError:
+                    pass
+        return freed
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# (C) Copyright 2008 Kulbir Saini <kulbirsaini@students.iiit.ac.in>
+#
+
+"""
+HTTP server which streams packages to clients while they are being
+downloaded. A client is sent the part of the package which is in
+temp_dir already and then follows the download worker writing to the
+file until the package is complete.
+"""
+
+__author__ = """Kulbir Saini <kulbirsaini@students.iiit.ac.in>"""
+__docformat__ = 'plaintext'
+
+from canonical import mark_upstream
+import BaseHTTPServer
+import os
+import socket
+import SocketServer
+import time
+import urllib
+
+# Size of the blocks sent to the client.
+block_size = 64 * 1024
+# Interval at which a client waiting for more data checks the file again.
+poll_interval = 0.2
+
+class StreamRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handle GET /<type>/<package key>?<url>. url is where the client is sent if
+    the package can't be streamed, e.g. because its download failed. It is
+    marked so that the rewriter lets the client fetch it from upstream.
+    """
+    def do_GET(self):
+        try:
+            (location, url) = (self.path.split('?', 1) + [''])[:2]
+            (type, package) = urllib.unquote(location).strip('/').split('/', 1)
+            url = urllib.unquote(url)
+            paths = self.server.locate(type.upper(), package)
+        except ValueError:
+            paths = None
+        if paths is None:
+            self.send_error(404)
+            return
+        try:
+            self.stream(package, paths[0], paths[1], url)
+        except (socket.error, IOError, OSError):
+            # The client has gone away or the package was evicted.
+            pass
+
+    def stream(self, package, path, download_path, url):
+        package_pool = self.server.package_pool
+        deadline = time.time() + self.server.wait
+        # Wait for the download worker to start writing the package.
+        while True:
+            if os.path.isfile(path):
+                self.send_file(open(path, 'rb'), os.stat(path)[6])
+                return
+            size = package_pool.get_conn_size(package)
+            if size != "NULL":
+                try:
+                    file = open(download_path, 'rb')
+                    break
+                except IOError:
+                    # The package was renamed into the cache meanwhile, or
+                    # its partial file was removed for a retry.
+                    time.sleep(poll_interval)
+                    continue
+            if package_pool.get_details(package) is False or time.time() > deadline:
+                # The package was dropped or is still waiting for a free
+                # download slot, so fetch it from upstream.
+                if os.path.isfile(path):
+                    continue
+                self.send_response(302)
+                self.send_header('Location', mark_upstream(url))
+                self.end_headers()
+                return
+            time.sleep(poll_interval)
+
+        try:
+            self.follow(file, package, path, size)
+        finally:
+            file.close()
+
+    def send_file(self, file, size):
+        """Send a complete package."""
+        try:
+            self.send_headers(size)
+            while True:
+                data = file.read(block_size)
+                if not data:
+                    break
+                self.wfile.write(data)
+        finally:
+            file.close()
+
+    def send_headers(self, size):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        if size >= 0:
+            self.send_header('Content-Length', str(size))
+        self.end_headers()
+
+    def follow(self, file, package, path, size):
+        """Send file while it is being written until the package is complete.
+        size is the expected size of the package or -1 if unknown."""
+        self.send_headers(size)
+        sent = 0
+        complete = False
+        while True:
+            data = file.read(block_size)
+            if data:
+                self.wfile.write(data)
+                sent += len(data)
+                continue
+            if complete or (size >= 0 and sent >= size):
+                return
+            stats = os.fstat(file.fileno())
+            if stats.st_size < sent:
+                # The download was restarted from scratch.
+                return
+            if not self.server.package_pool.is_active(package):
+                # The download is over. It was successful only if the file
+                # being read has been stored in the cache, or was removed
+                # because the cache had the same package already.
+                try:
+                    cached = os.stat(path)
+                    complete = cached.st_ino == stats.st_ino or (stats.st_nlink == 0 and cached.st_size == stats.st_size)
+                except OSError:
+                    complete = False
+                if not complete:
+                    return
+                continue
+            time.sleep(poll_interval)
+
+    def log_message(self, format, *args):
+        # stderr of intelligentmirror goes to squid's cache.log.
+        return
+
+class StreamServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Stream packages on address. locate(type, package) returns the paths of
+    the cached package and of its download in temp_dir, or None if type is
+    not cached. Clients wait up to wait seconds for a queued download to
+    start before being sent upstream.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, package_pool, locate, wait):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StreamRequestHandler)
+        self.package_pool = package_pool
+        self.locate = locate
+        self.wait = wait
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# (C) Copyright 2008 Kulbir Saini <kulbirsaini@students.iiit.ac.in>
+#
+
+"""
+Pool of pre-forked worker processes used to download packages. Every
+worker gets its jobs over a pipe from the parent and reports back over
+another pipe when a job is done, with 'd' if it was done and 'f' if it
+failed with an exception.
+"""
+
+__author__ = """Kulbir Saini <kulbirsaini@students.iiit.ac.in>"""
+__docformat__ = 'plaintext'
+
+import marshal
+import os
+import select
+import signal
+from rpc import frame, read_frame
+
+class DownloadWorker:
+    """
+    A worker process which calls function for every job sent to it. The
+    worker exits when the parent closes the job pipe.
+    """
+    def __init__(self, function, inherited = [], after_fork = None, before_exit = None):
+        self.function = function
+        self.package = None
+        (job_read, job_write) = os.pipe()
+        (done_read, done_write) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # Close the pipes of the other workers, otherwise they will
+            # never see the end of their job pipe.
+            for fd in inherited + [job_write, done_read]:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            # Don't hold on to the pipes connecting squid to the helper.
+            null = os.open(os.devnull, os.O_RDWR)
+            os.dup2(null, 0)
+            os.dup2(null, 1)
+            os.close(null)
+            # The handlers of the parent, installed after the first workers
+            # were forked, are for the parent only.
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            if after_fork is not None:
+                after_fork()
+            self.run(job_read, done_write)
+            if before_exit is not None:
+                before_exit()
+            os._exit(0)
+        os.close(job_read)
+        os.close(done_write)
+        self.pid = pid
+        self.jobs = job_write
+        self.done = done_read
+
+    def run(self, job_read, done_write):
+        """Main loop of the worker process."""
+        jobs = os.fdopen(job_read, 'rb')
+        while True:
+            try:
+                params = marshal.loads(read_frame(jobs))
+            except EOFError:
+                return
+            status = 'd'
+            try:
+                self.function(params)
+            except:
+                # function is expected to log its own errors. Those it
+                # didn't expect leave the package to the parent.
+                status = 'f'
+            try:
+                os.write(done_write, status)
+            except OSError:
+                # The parent has exited, e.g. on a reload, and the job pipe
+                # is closed as well.
+                return
+
+    def submit(self, params):
+        """Send a job to the worker."""
+        os.write(self.jobs, frame(marshal.dumps(params)))
+        self.package = params[4]
+
+    def close(self):
+        os.close(self.jobs)
+        os.close(self.done)
+
+class WorkerPool:
+    """
+    A fixed number of DownloadWorkers. Workers which die are replaced and
+    reported by reap() and jobs which fail are reported by failed(). Only
+    one thread should use a WorkerPool. The workers close the descriptors
+    in inherited. Every worker calls after_fork first. Workers are replaced
+    while the parent runs threads, so after_fork should re-create the locks
+    other threads may have held at the time of the fork. Workers call
+    before_exit when they exit, as they exit without running the exit
+    handlers of the parent.
+    """
+    def __init__(self, size, function, inherited = [], after_fork = None, before_exit = None):
+        self.function = function
+        self.inherited = inherited
+        self.after_fork = after_fork
+        self.before_exit = before_exit
+        self.workers = []
+        self.died = []
+        self.failures = []
+        for i in range(size):
+            self.workers.append(self.spawn())
+
+    def spawn(self):
+        inherited = self.inherited[:]
+        for worker in self.workers:
+            inherited += [worker.jobs, worker.done]
+        return DownloadWorker(self.function, inherited, self.after_fork, self.before_exit)
+
+    def replace(self, worker):
+        """Replace a worker which has exited or is exiting."""
+        try:
+            os.waitpid(worker.pid, 0)
+        except OSError:
+            pass
+        if worker.package is not None:
+            self.died.append((worker.pid, worker.package))
+        worker.close()
+        self.workers.remove(worker)
+        self.workers.append(self.spawn())
+
+    def collect(self, timeout = 0):
+        """Mark the workers which have finished their jobs as idle."""
+        busy = [worker.done for worker in self.workers if worker.package is not None]
+        if len(busy) == 0:
+            return
+        ready = select.select(busy, [], [], timeout)[0]
+        for worker in self.workers[:]:
+            if worker.done in ready:
+                status = os.read(worker.done, 1)
+                if status:
+                    if status == 'f':
+                        self.failures.append((worker.pid, worker.package))
+                    worker.package = None
+                else:
+                    # Nothing left to read, the worker has died.
+                    self.replace(worker)
+
+    def submit(self, params):
+        """Send a job to an idle worker, waiting for one if all are busy.
+        Returns the pid of the worker."""
+        while True:
+            self.collect()
+            idle = [worker for worker in self.workers if worker.package is None]
+            if len(idle) == 0:
+                self.collect(None)
+                continue
+            try:
+                idle[0].submit(params)
+                return idle[0].pid
+            except OSError:
+                # The worker has died while it was idle.
+                self.replace(idle[0])
+
+    def reap(self):
+        """Replace the workers which have exited. Returns the list of
+        (pid, package) for the workers which died while downloading."""
+        self.collect()
+        for worker in self.workers[:]:
+            try:
+                pid = os.waitpid(worker.pid, os.WNOHANG)[0]
+            except OSError:
+                pid = worker.pid
+            if pid != 0:
+                self.replace(worker)
+        died = self.died
+        self.died = []
+        return died
+
+    def failed(self):
+        """Return the list of (pid, package) for the jobs which failed with
+        an exception since the last call. Call reap() first."""
+        failures = self.failures
+        self.failures = []
+        return failures
@@ -49,6 +49,7 @@ mainconf =  readMainConfig(readStartupConfig(config_file, '/'))
 # Gloabl Options
 base_dir = mainconf.base_dir
 temp_dir = os.path.join(base_dir, mainconf.temp_dir)
+blob_dir = os.path.join(base_dir, mainconf.blob_dir)
 logfile = mainconf.logfile
 format = '%s'
 
@@ -63,7 +64,7 @@ rpm_cache_dir = os.path.join(base_dir, mainconf.rpm_cache_dir)
 deb_cache_dir = os.path.join(base_dir, mainconf.deb_cache_dir)
 
 # List of cache directories
-squid_cache_dir_list = [base_dir, temp_dir, rpm_cache_dir, deb_cache_dir]
+squid_cache_dir_list = [base_dir, temp_dir, blob_dir, rpm_cache_dir, deb_cache_dir]
 
 def set_logging():
     logging.basicConfig(level=logging.DEBUG,
@@ -298,6 +299,10 @@ def setup():
     if not create_file(os.path.join(squid_log_dir, 'intelligentmirror.log'), squid_user, squid_group):
         error(INSTALL_ERROR)
 
+    # Written by the helpers, which run as squid and can't create files in /etc .
+    if not create_file('/etc/intelligentmirror.conf.snapshot', squid_user, squid_group, 0644):
+        error(INSTALL_ERROR)
+
     if not generate_httpd_conf():
         error(INSTALL_ERROR)
 